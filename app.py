@@ -1,6 +1,8 @@
 import sys
+from PySide6.QtCore import QTimer
 from PySide6.QtWidgets import QApplication
 
+from src.lazy import preload
 from src.mainWindow import MainWindow
 
 if __name__ == '__main__':
@@ -9,6 +11,8 @@ if __name__ == '__main__':
         w = MainWindow()
         w.resize(800, 600)
         w.show()
+        # torch and scipy load in the background once the window is up.
+        QTimer.singleShot(0, preload)
         app.exec()
     except Exception as e:
         print(f"Error: {e}")
\ No newline at end of file
@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Measures cold start: every run is a fresh interpreter that imports the app,
+# shows the main window and stops at its first paint. The child reports its
+# timings as one JSON line on stdout.
+
+HEAVY = ('torch', 'scipy', 'matplotlib')
+
+
+def child():
+    start = time.perf_counter()
+    from PySide6.QtCore import QEvent, QObject, QTimer
+    from PySide6.QtWidgets import QApplication
+
+    from src.lazy import preload
+    from src.mainWindow import MainWindow
+    imported = time.perf_counter()
+
+    timings = {'import': imported - start}
+
+    class FirstPaint(QObject):
+        def eventFilter(self, obj, ev):
+            if ev.type() == QEvent.Type.Paint and 'firstFrame' not in timings:
+                timings['firstFrame'] = time.perf_counter() - start
+                QTimer.singleShot(0, app.quit)
+            return False
+
+    app = QApplication(sys.argv)
+    w = MainWindow()
+    w.resize(800, 600)
+    firstPaint = FirstPaint()
+    w.installEventFilter(firstPaint)
+    w.show()
+    QTimer.singleShot(10000, app.quit)
+    app.exec()
+
+    loaded = [name for name in HEAVY if name in sys.modules]
+    preloadStart = time.perf_counter()
+    preload().join()
+    timings['preload'] = time.perf_counter() - preloadStart
+    print(json.dumps({'timings': timings, 'loadedAtFirstFrame': loaded}))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark application startup.')
+    parser.add_argument('--runs', type=int, default=5, help='number of cold starts')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child()
+        return 0
+
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    runs = []
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child'], env=env,
+                                capture_output=True, text=True, check=True)
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    summary = {'runs': runs}
+    for key in ('import', 'firstFrame', 'preload'):
+        values = np.array([run['timings'][key] for run in runs if key in run['timings']]) * 1000
+        if values.size:
+            summary[key] = {'meanMs': float(values.mean()), 'minMs': float(values.min())}
+            print(f"{key:>10}: mean {values.mean():8.1f} ms, min {values.min():8.1f} ms")
+    print(f"loaded at first frame: {runs[-1]['loadedAtFirstFrame'] or 'none of ' + ', '.join(HEAVY)}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(summary, file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,98 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide6.QtCore import QEvent, QPointF, Qt
+from PySide6.QtGui import QMouseEvent
+from PySide6.QtWidgets import QApplication
+
+from src.scribble import Scribble
+
+# Replays a recorded stroke on a Scribble widget and reports the time per
+# frame, i.e. handling the mouse moves that arrive between two repaints plus
+# the repaint itself. A stroke file is a JSON list of [x, y] points.
+
+
+def syntheticStroke(width: int, height: int, points: int = 2000) -> list:
+    # A spiral over most of the image, sampled like a fast mouse would report it.
+    t = np.linspace(0, 1, points)
+    radius = 0.45 * min(width, height) * t
+    x = width / 2 + radius * np.cos(12 * math.pi * t)
+    y = height / 2 + radius * np.sin(12 * math.pi * t)
+    return np.stack((x, y), axis=1).tolist()
+
+def mouseEvent(eventType, point: QPointF) -> QMouseEvent:
+    return QMouseEvent(eventType, point, point, Qt.MouseButton.LeftButton,
+                       Qt.MouseButton.LeftButton, Qt.KeyboardModifier.NoModifier)
+
+def replay(scribble: Scribble, stroke: list, movesPerFrame: int, fullRepaint: bool) -> list:
+    app = QApplication.instance()
+    scribble.mousePressEvent(mouseEvent(QEvent.Type.MouseButtonPress, QPointF(*stroke[0])))
+    app.processEvents()
+
+    frames = []
+    for start in range(1, len(stroke), movesPerFrame):
+        frameStart = time.perf_counter()
+        for x, y in stroke[start:start + movesPerFrame]:
+            scribble.mouseMoveEvent(mouseEvent(QEvent.Type.MouseMove, QPointF(x, y)))
+        # Fire the coalescing timer right away instead of waiting for it.
+        scribble.repaintTimer.stop()
+        if fullRepaint:
+            scribble.render()
+        else:
+            scribble.flushRepaint()
+        app.processEvents()
+        frames.append(time.perf_counter() - frameStart)
+    return frames
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark stroke rendering in the scribble view.')
+    parser.add_argument('image', nargs='?', default='boy.jpg', help='background image')
+    parser.add_argument('--stroke', help='JSON file with the recorded stroke points')
+    parser.add_argument('--moves-per-frame', type=int, default=4,
+                        help='mouse moves arriving between two repaints')
+    parser.add_argument('--pen-width', type=int, default=10)
+    parser.add_argument('--full', action='store_true', help='repaint the whole view every frame')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    scribble = Scribble(args.image)
+    scribble.setPenWidth(args.pen_width)
+    scribble.show()
+    app.processEvents()
+
+    if args.stroke:
+        with open(args.stroke) as file:
+            stroke = json.load(file)
+    else:
+        stroke = syntheticStroke(scribble.bgWidth, scribble.bgHeight)
+
+    frames = np.array(replay(scribble, stroke, args.moves_per_frame, args.full)) * 1000
+    results = {
+        'image': args.image,
+        'size': [scribble.bgWidth, scribble.bgHeight],
+        'points': len(stroke),
+        'frames': len(frames),
+        'fullRepaint': args.full,
+        'meanFrameMs': float(frames.mean()),
+        'p95FrameMs': float(np.percentile(frames, 95)),
+        'maxFrameMs': float(frames.max()),
+    }
+    print(f"{results['frames']} frames on {results['size'][0]}x{results['size'][1]}: "
+          f"mean {results['meanFrameMs']:.3f} ms, p95 {results['p95FrameMs']:.3f} ms, "
+          f"max {results['maxFrameMs']:.3f} ms")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Headless and CPU only; both have to be set before Qt and torch load. The
+# result cache is kept in memory, read when src.cache loads, so clearing it
+# never touches the user's disk store.
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+os.environ['POISSON_CACHE_DIR'] = ''
+
+import numpy as np
+
+from PySide6.QtCore import QRectF, Qt
+from PySide6.QtGui import QColor, QImage, QPainter, QPen, QTransform
+from PySide6.QtWidgets import QApplication
+
+# After PySide6, so qimage2ndarray picks it up as its Qt binding.
+import qimage2ndarray as q2a
+
+from src import network
+from src.cache import resultCache
+from src.scribble import Scribble
+from src.tiles import TiledImage, compositeTiled, segmentTiled
+from src.utils import convertQ2N, getPixelData, poisson_edit, trimImage
+
+# Benchmarks the main pipeline stages over a sweep of image sizes and mask
+# fractions, on the sample images with synthetic elliptic masks. Each case is
+# run once under tracemalloc for the peak memory of NumPy and Python
+# allocations, then timed without it.
+
+SIZES = (256, 512, 1024)
+MASK_FRACTIONS = (0.05, 0.2, 0.5)
+STAGES = ('getPixelData', 'trimImage', 'poisson_edit', 'train', 'applyMask', 'copy',
+          'segmentTiled', 'compositeTiled')
+# Training stages are by far the slowest and only run on the smaller sizes.
+TRAIN_STAGES = ('train', 'applyMask', 'segmentTiled')
+TRAIN_SIZES = (256, 512)
+
+
+def loadSample(path: str, size: int) -> QImage:
+    img = QImage(path)
+    if img.isNull():
+        raise FileNotFoundError(f"Error reading image '{path}'")
+    img = img.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    return img.convertToFormat(QImage.Format.Format_ARGB32)
+
+def ellipseMask(height: int, width: int, fraction: float) -> np.ndarray:
+    # Centered ellipse with the image's aspect ratio covering `fraction` of it.
+    radius = np.sqrt(fraction / np.pi)
+    rows, cols = np.indices((height, width))
+    return (((rows + 0.5) / height - 0.5)**2 + ((cols + 0.5) / width - 0.5)**2) <= radius**2
+
+def drawScribbles(maskImage: QImage, fraction: float):
+    # Green stroke inside the object, red stroke along the image border.
+    width = maskImage.width()
+    height = maskImage.height()
+    radius = np.sqrt(fraction / np.pi)
+    painter = QPainter(maskImage)
+    pen = QPen(QColor('#00FF00'), max(2, min(width, height) // 50))
+    painter.setPen(pen)
+    painter.drawEllipse(QRectF(width * (0.5 - radius / 2), height * (0.5 - radius / 2),
+                               width * radius, height * radius))
+    pen.setColor(QColor('#FF0000'))
+    painter.setPen(pen)
+    painter.drawRect(QRectF(pen.width(), pen.width(), width - 2 * pen.width(), height - 2 * pen.width()))
+    painter.end()
+
+def measure(fn, repeat: int) -> dict:
+    # Every run starts from an empty result cache, so a stage that looks its
+    # result up computes it instead of timing the hit from the run before.
+    resultCache.clear()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Iteration counts and the like are reported from the last timed run.
+    times = []
+    hits = misses = 0
+    for _ in range(max(1, repeat)):
+        resultCache.clear()
+        start = time.perf_counter()
+        _, info = fn()
+        times.append(time.perf_counter() - start)
+        stats = resultCache.stats()
+        hits += stats['hits']
+        misses += stats['misses']
+
+    report = {
+        'wallTime': min(times),
+        'meanWallTime': float(np.mean(times)),
+        'peakTracedMemory': peak,
+        'maxRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'cacheHits': hits,
+        'cacheMisses': misses,
+    }
+    report.update(info)
+    return report
+
+def stageCases(stage: str, images: dict, size: int, fraction: float, solver: str, tileSize: int):
+    source, target, path = images['source'], images['target'], images['sourcePath']
+    img = convertQ2N(source)
+    mask = ellipseMask(source.height(), source.width(), fraction)
+
+    if stage == 'getPixelData':
+        return lambda: (getPixelData(mask, img), {})
+
+    if stage == 'trimImage':
+        cutout = source.copy()
+        q2a.alpha_view(cutout)[~mask] = 0
+        return lambda: (trimImage(cutout, cutout), {})
+
+    if stage == 'poisson_edit':
+        background = convertQ2N(target)[:source.height(), :source.width()].copy()
+        insert = img.copy()
+        def run():
+            info = {}
+            result = poisson_edit(background, insert, mask[:background.shape[0], :background.shape[1]],
+                                  solver, info)
+            return result, {'solver': info['solver'], 'unknowns': info['unknowns'],
+                            'iterations': info['iterations'], 'residual': info['residual']}
+        return run
+
+    if stage == 'train':
+        maskImage = QImage(source.size(), QImage.Format.Format_ARGB32)
+        maskImage.fill(QColor(0, 0, 0, 0))
+        drawScribbles(maskImage, fraction)
+        scribbles = convertQ2N(maskImage)
+        fgData = getPixelData(scribbles[:,:,1] == 255, img)
+        bgData = getPixelData(scribbles[:,:,0] == 255, img)
+        data = np.concatenate((fgData, bgData))
+        labels = np.concatenate((np.ones(fgData.shape[0]), np.zeros(bgData.shape[0])))
+        def run():
+            info = {}
+            result = network.train(data, labels, img, info=info)
+            return result, {'samples': info['samples'], 'epochs': info['epochs'],
+                            'stopReason': info['stopReason'], 'trainTime': info['trainTime'],
+                            'inferenceTime': info['inferenceTime']}
+        return run
+
+    if stage == 'applyMask':
+        def run():
+            # A fresh widget per run, so every run trains from scratch.
+            scribble = Scribble(path)
+            drawScribbles(scribble.maskImage, fraction)
+            scribble.applyMask()
+            info = scribble.segmentInfo
+            return None, {'epochs': info.get('epochs'), 'fitTime': info['fitTime'],
+                          'predictTime': info['predictTime']}
+        return run
+
+    if stage == 'segmentTiled':
+        maskImage = QImage(source.size(), QImage.Format.Format_ARGB32)
+        maskImage.fill(QColor(0, 0, 0, 0))
+        drawScribbles(maskImage, fraction)
+        tiledSource = TiledImage.fromQImage(source, tileSize)
+        tiledScribble = TiledImage.fromQImage(maskImage, tileSize)
+        def run():
+            info = {}
+            result = segmentTiled(tiledSource, tiledScribble, info=info)
+            return result, {'epochs': info['epochs'], 'trainTime': info['trainTime'],
+                            'inferenceTime': info['inferenceTime']}
+        return run
+
+    if stage == 'compositeTiled':
+        # The poisson_edit case on a memory-mapped background.
+        result = TiledImage.fromQImage(target, tileSize)
+        maskImage = QImage(source.size(), QImage.Format.Format_ARGB32)
+        maskImage.fill(QColor(0, 0, 0, 0))
+        q2a.raw_view(maskImage)[mask] = 0xFF00FF00
+        def run():
+            info = {}
+            compositeTiled(result, source, maskImage, QTransform(), 0, 0, 0, solver, info=info)
+            return result, {'solver': info['solver'], 'unknowns': info['unknowns'],
+                            'iterations': info['iterations'], 'residual': info['residual']}
+        return run
+
+    if stage == 'copy':
+        scribble = Scribble(path)
+        q2a.raw_view(scribble.maskImage)[mask] = 0xFF00FF00
+        return lambda: (scribble.copy(), {})
+
+    raise ValueError(f"Unknown stage '{stage}'.")
+
+def gitCommit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the segmentation and Poisson pipeline stages.')
+    parser.add_argument('--source', default='boy.jpg', help='image to segment and cut out')
+    parser.add_argument('--target', default='tower.jpg', help='background image for the Poisson edit')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='longest image side')
+    parser.add_argument('--train-sizes', type=int, nargs='+', default=TRAIN_SIZES,
+                        help='sizes the training stages run on')
+    parser.add_argument('--fractions', type=float, nargs='+', default=MASK_FRACTIONS,
+                        help='fraction of the image covered by the mask')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--solver', default='direct', help='Poisson solver backend')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile size of the tiled stages')
+    parser.add_argument('--threads', type=int, default=network.TRAIN_THREADS, help='torch threads')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file for the results')
+    args = parser.parse_args(argv)
+
+    network.TRAIN_THREADS = args.threads
+    # A large virtual screen, so Scribble keeps the benchmark sizes unscaled.
+    with tempfile.TemporaryDirectory() as tmp:
+        screenConfig = os.path.join(tmp, 'screen.json')
+        with open(screenConfig, 'w') as file:
+            json.dump({'screens': [{'name': 'benchmark', 'x': 0, 'y': 0, 'width': 16384, 'height': 16384,
+                                    'logicalDpi': 96, 'logicalBpi': 96, 'dpr': 1}]}, file)
+        os.environ['QT_QPA_PLATFORM'] = f'offscreen:configfile={screenConfig}'
+        app = QApplication.instance() or QApplication(sys.argv)
+
+        results = []
+        for size in args.sizes:
+            sourcePath = os.path.join(tmp, f'source{size}.png')
+            source = loadSample(args.source, size)
+            source.save(sourcePath)
+            images = {'source': source, 'sourcePath': sourcePath,
+                      'target': loadSample(args.target, 2 * size)}
+
+            for fraction in args.fractions:
+                for stage in args.stages:
+                    if stage in TRAIN_STAGES and size not in args.train_sizes:
+                        continue
+                    report = measure(stageCases(stage, images, size, fraction, args.solver, args.tile_size),
+                                     args.repeat)
+                    report.update(stage=stage, size=[source.width(), source.height()], maskFraction=fraction)
+                    results.append(report)
+                    print(f"{stage:>13} {source.width():>5}x{source.height():<5} mask {fraction:.2f}: "
+                          f"{report['wallTime'] * 1000:9.2f} ms, peak {report['peakTracedMemory'] / 2**20:8.1f} MiB, "
+                          f"cache {report['cacheHits']} hits {report['cacheMisses']} misses")
+
+    summary = {
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'threads': args.threads,
+        'source': args.source,
+        'target': args.target,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(summary, file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
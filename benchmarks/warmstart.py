@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+
+import numpy as np
+
+from benchmarks.suite import ellipseMask, loadSample
+from src.utils import POISSON_SOLVERS, PoissonWarmStart, convertQ2N, poisson_edit
+
+# Replays a sequence of small moves of the insert and solves every placement
+# twice: cold, and warm from the previous placement (reused factorization or
+# multigrid hierarchy, previous solution as initial guess).
+
+NUDGES = ((0, 0), (2, 1), (2, 1), (-3, 2), (5, -4), (1, 0))
+
+
+def placement(background: np.ndarray, insert: np.ndarray, mask: np.ndarray, x: int, y: int):
+    target = np.zeros_like(background)
+    placed = np.zeros(background.shape[:2], dtype=bool)
+    height, width = mask.shape
+    target[y:y + height, x:x + width] = insert
+    placed[y:y + height, x:x + width] = mask
+    return target, placed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark cold against warm-started Poisson re-solves.')
+    parser.add_argument('--source', default='boy.jpg', help='image the insert is cut from')
+    parser.add_argument('--target', default='tower.jpg', help='background image')
+    parser.add_argument('--size', type=int, default=512, help='longest side of the background')
+    parser.add_argument('--fraction', type=float, default=0.3, help='insert area as a fraction of its image')
+    parser.add_argument('--solvers', nargs='+', default=('direct', 'multigrid', 'lsqr'),
+                        choices=[solver for solver in POISSON_SOLVERS if solver != 'dst'])
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    # The views do not keep their QImages alive, so those are held until
+    # the copies are taken.
+    backgroundImage = loadSample(args.target, args.size)
+    insertImage = loadSample(args.source, args.size // 3)
+    background = convertQ2N(backgroundImage).copy()
+    insert = convertQ2N(insertImage).copy()
+    mask = ellipseMask(insert.shape[0], insert.shape[1], args.fraction)
+
+    results = {}
+    for solver in args.solvers:
+        warmStart = PoissonWarmStart()
+        x = (background.shape[1] - insert.shape[1]) // 2
+        y = (background.shape[0] - insert.shape[0]) // 2
+        steps = []
+        for dx, dy in NUDGES:
+            x += dx
+            y += dy
+            target, placed = placement(background, insert, mask, x, y)
+            step = {}
+            for name, state in (('cold', None), ('warm', warmStart)):
+                info = {}
+                poisson_edit(background, target, placed, solver, info, warmStart=state)
+                step[name] = {key: info[key] for key in ('iterations', 'solveTime', 'residual',
+                                                         'warm', 'reusedOperator')}
+            steps.append(step)
+            print(f"{solver:>9} ({dx:+d}, {dy:+d}): cold {step['cold']['iterations']:4d} it "
+                  f"{step['cold']['solveTime'] * 1000:8.1f} ms, warm {step['warm']['iterations']:4d} it "
+                  f"{step['warm']['solveTime'] * 1000:8.1f} ms")
+
+        # The first placement has nothing to start from.
+        cold = np.array([step['cold']['solveTime'] for step in steps[1:]])
+        warm = np.array([step['warm']['solveTime'] for step in steps[1:]])
+        results[solver] = {'steps': steps, 'coldMs': float(cold.mean() * 1000),
+                           'warmMs': float(warm.mean() * 1000), 'speedup': float(cold.mean() / warm.mean())}
+        print(f"{solver:>9}: mean cold {cold.mean() * 1000:.1f} ms, warm {warm.mean() * 1000:.1f} ms, "
+              f"speedup {cold.mean() / warm.mean():.1f}x")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'size': args.size, 'fraction': args.fraction, 'nudges': NUDGES, 'solvers': results},
+                      file, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,189 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PySide6.QtGui import QImage, QTransform
+import qimage2ndarray as q2a
+
+from src import network
+from src.scribble import classMask, segmentImage, writeMask
+from src.tiles import TiledImage, compositeTiled, segmentTiled, writeMaskTiled
+from src.utils import convertQ2N, convertN2Q, maskBounds, placeInsert, poisson_edit
+
+# Manifest format (JSON), paths relative to the manifest file:
+# {"jobs": [{"name": "boy-on-tower", "source": "boy.jpg", "scribble": "boy-scribble.png",
+#            "target": "tower.jpg", "x": 120, "y": 80, "scale": 0.5, "class": 1}, ...]}
+# "class" picks the object to blend from a scribble with several object
+# classes (see SCRIBBLE_PALETTE), the first one by default.
+
+
+def loadImage(path: str) -> QImage:
+    img = QImage(path)
+    if img.isNull():
+        raise FileNotFoundError(f"Error reading image '{path}'")
+    return img.convertToFormat(QImage.Format.Format_ARGB32)
+
+def cutout(source: TiledImage, mask: np.ndarray):
+    # The segmented object and its mask as QImages, cropped to the mask with
+    # trimImage's padding so placeInsert trims them to the same region.
+    bounds = maskBounds(mask, padding=3)
+    if bounds is None:
+        raise RuntimeError('No mask found.')
+    region = mask[bounds]
+    img = QImage(region.shape[1], region.shape[0], QImage.Format.Format_ARGB32)
+    q2a.rgb_view(img)[:] = source.pixels[bounds]
+    q2a.alpha_view(img)[:] = 255
+    maskImg = QImage(region.shape[1], region.shape[0], QImage.Format.Format_ARGB32)
+    maskImg.fill(0)
+    q2a.raw_view(maskImg)[region] = 0xFF00FF00
+    return img, maskImg
+
+def runTiledJob(job: dict, outputDir: str, solver: str, threshold: float, backend: str) -> dict:
+    # Same steps as runJob on memory-mapped tiled images: only the scribbled
+    # pixels, the object and the Poisson region around it are held in memory.
+    timings = {}
+    start = time.perf_counter()
+
+    source = TiledImage.fromFile(job['source'])
+    scribble = TiledImage.fromFile(job['scribble'])
+    target = TiledImage.fromFile(job['target'])
+    timings['load'] = time.perf_counter() - start
+
+    stageStart = time.perf_counter()
+    training = {}
+    mask = writeMaskTiled(segmentTiled(source, scribble, info=training, backend=backend), threshold,
+                          job.get('class', 1))
+    timings['segment'] = time.perf_counter() - stageStart
+
+    stageStart = time.perf_counter()
+    img, maskImg = cutout(source, mask)
+    scale = job.get('scale', 1.0)
+    info = {}
+    compositeTiled(target, img, maskImg, QTransform().scale(scale, scale), job.get('x', 0), job.get('y', 0), 0,
+                   solver, info=info)
+    timings['poisson'] = time.perf_counter() - stageStart
+
+    outputPath = os.path.join(outputDir, f"{job['name']}.png")
+    target.save(outputPath)
+    timings['total'] = time.perf_counter() - start
+    return writeReport(job, outputDir, outputPath, timings, training, info)
+
+def writeReport(job: dict, outputDir: str, outputPath: str, timings: dict, training: dict, info: dict) -> dict:
+    report = {
+        'job': job,
+        'output': outputPath,
+        'timings': timings,
+        'training': training,
+        'solver': {key: info[key] for key in ('solver', 'unknowns', 'iterations', 'residual')},
+    }
+    with open(os.path.join(outputDir, f"{job['name']}.json"), 'w') as file:
+        json.dump(report, file, indent=2)
+    return report
+
+def runJob(job: dict, outputDir: str, solver: str, threshold: float, backend: str,
+           superpixels: int, tiled: bool = False) -> dict:
+    if tiled:
+        if superpixels:
+            raise ValueError('Superpixels are not supported for tiled images.')
+        return runTiledJob(job, outputDir, solver, threshold, backend)
+
+    timings = {}
+    start = time.perf_counter()
+
+    source = loadImage(job['source'])
+    maskImage = loadImage(job['scribble'])
+    target = loadImage(job['target'])
+    timings['load'] = time.perf_counter() - start
+
+    stageStart = time.perf_counter()
+    training = {}
+    probabilities = segmentImage(source, maskImage, info=training, backend=backend,
+                                 superpixels=superpixels)
+    writeMask(maskImage, probabilities, threshold)
+    maskImage = classMask(maskImage, job.get('class', 1))
+    timings['segment'] = time.perf_counter() - stageStart
+
+    stageStart = time.perf_counter()
+    scale = job.get('scale', 1.0)
+    targetImg, maskImg = placeInsert(source, maskImage, target.width(), target.height(),
+                                     QTransform().scale(scale, scale), job.get('x', 0), job.get('y', 0), 0)
+    background = convertQ2N(target)
+    insert = convertQ2N(targetImg)
+    maskBool = convertQ2N(maskImg)[:,:,1] == 255
+    timings['place'] = time.perf_counter() - stageStart
+
+    stageStart = time.perf_counter()
+    info = {}
+    result = poisson_edit(background, insert, maskBool, solver, info)
+    timings['poisson'] = time.perf_counter() - stageStart
+
+    outputPath = os.path.join(outputDir, f"{job['name']}.png")
+    convertN2Q(result).save(outputPath)
+    timings['total'] = time.perf_counter() - start
+    return writeReport(job, outputDir, outputPath, timings, training, info)
+
+def initWorker(threads: int):
+    network.TRAIN_THREADS = threads
+
+def loadManifest(path: str) -> list:
+    with open(path) as file:
+        manifest = json.load(file)
+
+    baseDir = os.path.dirname(os.path.abspath(path))
+    jobs = manifest['jobs'] if isinstance(manifest, dict) else manifest
+    for index, job in enumerate(jobs):
+        job.setdefault('name', f"job{index:04d}")
+        for key in ('source', 'scribble', 'target'):
+            job[key] = os.path.join(baseDir, job[key])
+    return jobs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Segment and Poisson-blend images headlessly.')
+    parser.add_argument('manifest', help='JSON manifest describing the jobs')
+    parser.add_argument('-o', '--output', default='output', help='output directory')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--solver', default='direct', help='Poisson solver backend')
+    parser.add_argument('--backend', default='mlp', help='segmentation backend')
+    parser.add_argument('--superpixels', type=int, default=0,
+                        help='train and predict on about this many superpixels (0 = per pixel)')
+    parser.add_argument('--threshold', type=float, default=0.6, help='segmentation threshold')
+    parser.add_argument('--tiled', action='store_true',
+                        help='process memory-mapped tiles instead of whole images (for very large images)')
+    args = parser.parse_args(argv)
+
+    jobs = loadManifest(args.manifest)
+    os.makedirs(args.output, exist_ok=True)
+    workers = max(1, min(args.workers, len(jobs)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    reports = []
+    failed = 0
+    start = time.perf_counter()
+    # Spawned workers so that no Qt or torch state is inherited through fork.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=initWorker, initargs=(threads,)) as pool:
+        futures = {pool.submit(runJob, job, args.output, args.solver, args.threshold,
+                               args.backend, args.superpixels, args.tiled): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                failed += 1
+                report = {'job': job, 'error': str(e)}
+                print(f"{job['name']}: failed: {e}")
+            else:
+                print(f"{job['name']}: {report['timings']['total']:.2f}s")
+            reports.append(report)
+
+    summary = {'workers': workers, 'wall': time.perf_counter() - start, 'jobs': reports}
+    with open(os.path.join(args.output, 'timings.json'), 'w') as file:
+        json.dump(summary, file, indent=2)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from numpy import ndarray
+
+# Results are stored under a hash of everything they were computed from.
+# POISSON_CACHE_DIR='' keeps the cache in memory only.
+CACHE_DIR = os.environ.get('POISSON_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'praktikum23'))
+MEMORY_ENTRIES = 32
+DISK_LIMIT = 512 * 2**20
+
+
+def cacheKey(*parts) -> str:
+    # Arrays are hashed by shape, dtype and contents, everything else by repr.
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if isinstance(part, ndarray):
+            digest.update(f"{part.shape}{part.dtype}".encode())
+            digest.update(np.ascontiguousarray(part).data)
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory: str = CACHE_DIR, memoryEntries: int = MEMORY_ENTRIES,
+                 diskLimit: int = DISK_LIMIT):
+        self.directory = directory
+        self.memoryEntries = memoryEntries
+        self.diskLimit = diskLimit
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, key: str) -> ndarray:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+        value = None
+        if self.directory:
+            try:
+                value = np.load(self.path(key))
+                # The modification time orders the disk store for eviction.
+                os.utime(self.path(key))
+            except (OSError, ValueError):
+                value = None
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.diskHits += 1
+            self.remember(key, value)
+        return value
+
+    def put(self, key: str, value: ndarray):
+        with self.lock:
+            self.remember(key, value)
+        if not self.directory:
+            return
+
+        # Written under a temporary name first, so readers never see half a file.
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmpPath = os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp")
+            with open(tmpPath, 'wb') as file:
+                np.save(file, value)
+            os.replace(tmpPath, self.path(key))
+            self.trimDisk()
+        except OSError as e:
+            print(f"Could not write cache entry: {e}")
+
+    def remember(self, key: str, value: ndarray):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memoryEntries:
+            self.memory.popitem(last=False)
+
+    def diskEntries(self) -> list:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def trimDisk(self):
+        # Least recently used files go first once the store exceeds its cap.
+        entries = sorted(self.diskEntries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.diskLimit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> dict:
+        diskBytes = 0
+        if self.directory and os.path.isdir(self.directory):
+            diskBytes = sum(size for _, size, _ in self.diskEntries())
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'diskHits': self.diskHits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+                'memoryEntries': len(self.memory),
+                'diskBytes': diskBytes,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.hits = self.diskHits = self.misses = 0
+        if self.directory and os.path.isdir(self.directory):
+            for _, _, path in self.diskEntries():
+                os.remove(path)
+
+
+resultCache = ResultCache()
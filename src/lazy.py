@@ -0,0 +1,43 @@
+import importlib
+import threading
+
+# Heavy dependencies that the window does not need to appear; they are
+# imported on first use, or ahead of time by preload().
+HEAVY_MODULES = ('torch', 'src.network', 'scipy.sparse', 'scipy.sparse.linalg', 'scipy.ndimage',
+                 'scipy.fft', 'scipy.linalg', 'scipy.spatial', 'scipy.special')
+
+
+class LazyModule:
+    # Stands in for a module until the first attribute access imports it.
+    # The import machinery serializes concurrent imports, so this is safe to
+    # race against preload().
+    def __init__(self, name: str):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr: str):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+
+def lazyImport(name: str) -> LazyModule:
+    return LazyModule(name)
+
+def preload(names=HEAVY_MODULES) -> threading.Thread:
+    # Imports the modules on a daemon thread, e.g. once the window is shown.
+    def run():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                print(f"Preloading {name} failed: {e}")
+
+    thread = threading.Thread(target=run, name='preload', daemon=True)
+    thread.start()
+    return thread
@@ -1,12 +1,21 @@
-from PySide6.QtWidgets import QMainWindow, QToolBar, QGridLayout, QWidget, QFileDialog, QLabel, QSpinBox, QMessageBox
-from PySide6.QtGui import QAction, QImage, QColor, QPainter, QPixmap
-from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QMainWindow, QToolBar, QGridLayout, QWidget, QFileDialog, QLabel, QSpinBox, QMessageBox, QComboBox
+from PySide6.QtGui import QAction, QColor, QIcon, QPixmap
+from PySide6.QtCore import Qt, QThreadPool
 
+from src.cache import cacheKey, resultCache
 from src.merge import Merge
-from src.scribble import Scribble
-from src.utils import convertQ2N, convertN2Q, poisson_edit, trimImage
-
+from src.scribble import PALETTE, Scribble
+from src.segmentation import BACKENDS
+from src.superpixel import SUPERPIXELS
+from src.tracing import span
+from src.utils import convertQ2N, convertN2Q, placeInsert, poisson_edit
+from src.worker import Worker
+
+import numpy as np
 import os
+import qimage2ndarray as q2a
+
+POISSON_SOLVER = 'direct'
 
 class MyAction(QAction):
     def __init__(self):
@@ -23,18 +32,21 @@ class MainWindow(QMainWindow):
         self.scribble = None
         self.trained = False
         self.done = False
+        self.worker = None
+        # Single-object mask of the class cut out by the last Apply Mask
+        self.insertMask = None
 
         self.setWindowTitle("Image Poisson App")
         toolbar = QToolBar("main toolbar")
         self.addToolBar(toolbar)
 
-        tbImportScribble = QAction("Import Scribble Image", self)
-        tbImportScribble.triggered.connect(self.onTbButtonOneClick)
-        toolbar.addAction(tbImportScribble)
+        self.tbImportScribble = QAction("Import Scribble Image", self)
+        self.tbImportScribble.triggered.connect(self.onTbButtonOneClick)
+        toolbar.addAction(self.tbImportScribble)
 
-        tbImportMerge = QAction("Import Merge Image", self)
-        tbImportMerge.triggered.connect(self.onTbButtonTwoClick)
-        toolbar.addAction(tbImportMerge)
+        self.tbImportMerge = QAction("Import Merge Image", self)
+        self.tbImportMerge.triggered.connect(self.onTbButtonTwoClick)
+        toolbar.addAction(self.tbImportMerge)
 
         self.penSpin = QSpinBox(self)
         self.penSpin.setMinimum(1)
@@ -53,26 +65,62 @@ class MainWindow(QMainWindow):
         self.tbModeIndicator.setVisible(True)
         toolbar.addWidget(self.tbModeIndicator)
 
+        self.classBox = QComboBox(self)
+        for classIndex, color in enumerate(PALETTE):
+            pix = QPixmap(12, 12)
+            pix.fill(color)
+            self.classBox.addItem(QIcon(pix), f"Object {classIndex}" if classIndex else "Background")
+        self.classBox.setCurrentIndex(1)
+        self.classBox.currentIndexChanged.connect(self.changePenClass)
+        self.classBoxAction = toolbar.addWidget(self.classBox)
+        self.classBoxAction.setVisible(False)
+
         self.tbEraseToggle = QAction("Erase Toggle", self)
         self.tbEraseToggle.setVisible(False)
         toolbar.addAction(self.tbEraseToggle)
 
+        self.backendBox = QComboBox(self)
+        self.backendBox.addItems(list(BACKENDS))
+        self.backendBox.currentTextChanged.connect(self.changeBackend)
+        self.backendBoxAction = toolbar.addWidget(self.backendBox)
+        self.backendBoxAction.setVisible(False)
+
+        self.tbSuperpixels = QAction("Superpixels", self)
+        self.tbSuperpixels.setCheckable(True)
+        self.tbSuperpixels.setVisible(False)
+        self.tbSuperpixels.toggled.connect(self.toggleSuperpixels)
+        toolbar.addAction(self.tbSuperpixels)
+
         self.tbTrain = QAction("Train", self)
         self.tbTrain.setVisible(False)
         toolbar.addAction(self.tbTrain)
 
         self.tbApplyMask = QAction("Apply Mask", self)
         self.tbApplyMask.setVisible(False)
+        self.tbApplyMask.triggered.connect(self.copyMask)
         toolbar.addAction(self.tbApplyMask)
 
         self.tbPoissonEdit = QAction("Poisson Edit", self)
         self.tbPoissonEdit.setVisible(False)
+        self.tbPoissonEdit.triggered.connect(self.applyPoisson)
         toolbar.addAction(self.tbPoissonEdit)
 
+        self.tbLivePreview = QAction("Live Preview", self)
+        self.tbLivePreview.setCheckable(True)
+        self.tbLivePreview.setVisible(False)
+        self.tbLivePreview.toggled.connect(self.toggleLivePreview)
+        toolbar.addAction(self.tbLivePreview)
+
         self.tbSaveImage = QAction("Save Result", self)
         self.tbSaveImage.setVisible(False)
+        self.tbSaveImage.triggered.connect(self.saveImage)
         toolbar.addAction(self.tbSaveImage)
 
+        self.tbCancel = QAction("Cancel", self)
+        self.tbCancel.setVisible(False)
+        self.tbCancel.triggered.connect(self.cancelWorker)
+        toolbar.addAction(self.tbCancel)
+
         self.gridLayout = QGridLayout()
 
         mainWidget = QWidget()
@@ -82,7 +130,6 @@ class MainWindow(QMainWindow):
     def showMaskButton(self):
         if self.merge is None:
             return
-        self.tbApplyMask.triggered.connect(self.copyMask)
         self.tbApplyMask.setVisible(True)
 
     def onTbButtonOneClick(self):
@@ -104,10 +151,15 @@ class MainWindow(QMainWindow):
         self.scribble = Scribble(path[0])
         self.penSpinAction.setVisible(True)
         self.tbSwitchPenColor.setVisible(True)
+        self.classBoxAction.setVisible(True)
         self.tbEraseToggle.setVisible(True)
         self.tbTrain.setVisible(True)
+        self.backendBoxAction.setVisible(True)
+        self.tbSuperpixels.setVisible(True)
 
-        self.colorIndicator(QColor('#00FF00'))
+        self.changeBackend(self.backendBox.currentText())
+        self.toggleSuperpixels(self.tbSuperpixels.isChecked())
+        self.changePenClass(self.classBox.currentIndex())
         self.changePenWidth(self.penSpin.value())
 
         self.gridLayout.addWidget(self.scribble, 0, 0)
@@ -120,20 +172,28 @@ class MainWindow(QMainWindow):
             return
         
         if self.merge is not None:
+            self.merge.cancelPreview()
             self.gridLayout.removeWidget(self.merge)
             self.merge.deleteLater()
             self.tbPoissonEdit.setVisible(False)
+            self.tbLivePreview.setVisible(False)
             self.tbSaveImage.setVisible(False)
 
         self.merge = Merge(path[0])
+        self.merge.livePreview = self.tbLivePreview.isChecked()
         self.gridLayout.addWidget(self.merge, 0, 1)
         if self.trained:
             self.showMaskButton()
 
     def switchMode(self):
         color = self.scribble.switchColor()
+        self.classBox.setCurrentIndex(self.scribble.penClass)
         self.colorIndicator(color)
 
+    def changePenClass(self, classIndex: int):
+        if self.scribble is not None:
+            self.colorIndicator(self.scribble.setPenClass(classIndex))
+
     def toggleErase(self):
         color = self.scribble.toggleErase()
         self.colorIndicator(color)
@@ -146,65 +206,170 @@ class MainWindow(QMainWindow):
     def changePenWidth(self, val: int):
         self.scribble.setPenWidth(val)
 
+    def changeBackend(self, backend: str):
+        if self.scribble is not None:
+            self.scribble.backend = backend
+
+    def toggleSuperpixels(self, checked: bool):
+        if self.scribble is not None:
+            self.scribble.superpixels = SUPERPIXELS if checked else 0
+
+    def toggleLivePreview(self, checked: bool):
+        if self.merge is not None:
+            self.merge.setLivePreview(checked)
+
     def trainAndEval(self):
-        try:
-            self.scribble.applyMask()
-        except RuntimeError as e:
-            self.showErrorWindow('Error in segmentation', e)
+        if self.worker is not None:
             return
+        probabilities = self.scribble.cachedSegment()
+        if probabilities is not None:
+            self.onSegmented(probabilities)
+            return
+        worker = Worker(self.scribble.segment, progressFormat='Segmentation step {0}, {1:.4f}')
+        self.startWorker(worker, self.onSegmented, 'Error in segmentation')
+
+    def onSegmented(self, probabilities):
+        self.scribble.setMask(probabilities)
+        info = self.scribble.segmentInfo
+        if info.get('cached'):
+            self.showCacheMessage(info['backend'])
+        else:
+            self.statusBar().showMessage(f"{info['backend']}: fit {info['fitTime']:.2f}s, "
+                                         f"predict {info['predictTime']:.2f}s")
         self.showMaskButton()
         self.trained = True
 
     def copyMask(self):
+        if self.worker is not None or self.scribble is None or self.merge is None:
+            return
         try:
-            copy = self.scribble.copy()
+            # The object class last scribbled with; all of them come out of
+            # the same segmentation.
+            classIndex = self.scribble.objectClass
+            with span('copyMask.copy', classIndex=classIndex):
+                copy = self.scribble.copy(classIndex)
+                self.insertMask = self.scribble.classMask(classIndex)
         except RuntimeError as e:
             self.showErrorWindow('Error retrieving mask', e)
             return
-        self.merge.paste(copy)
-        self.tbPoissonEdit.triggered.connect(self.applyPoisson)
+        with span('copyMask.paste', image=copy):
+            self.merge.paste(copy)
         self.tbPoissonEdit.setVisible(True)
+        self.tbLivePreview.setVisible(True)
 
     def applyPoisson(self):
+        # A cached result is applied synchronously and resets the merge, so
+        # a repeated trigger finds no insert left and does nothing.
+        if self.worker is not None or self.merge is None or not self.merge.isEdit:
+            return
         os.environ['KMP_DUPLICATE_LIB_OK']='True'
-        trimmedTargetImg = trimImage(self.scribble.bgImage, self.scribble.maskImage)
-        trimmedMaskImg = trimImage(self.scribble.maskImage, self.scribble.maskImage)
-        scaledTargetImg = trimmedTargetImg.transformed(self.merge.transformScale)
-        scaledMaskImg = trimmedMaskImg.transformed(self.merge.transformScale)
-
-        targetImg = QImage(self.merge.bgWidth, self.merge.bgHeight, QImage.Format.Format_ARGB32)
-        targetImg.fill(QColor(0, 0, 0, 0))
-        qpainterTrgt = QPainter(targetImg)
-        qpainterTrgt.drawImage(self.merge.transformX,
-                               self.merge.transformY,
-                               scaledTargetImg.scaledToWidth(self.merge.scaleX + scaledTargetImg.size().width()))
-        
-        qpainterTrgt.end()
-
-        maskImg = QImage(self.merge.bgWidth, self.merge.bgHeight, QImage.Format.Format_ARGB32)
-        maskImg.fill(QColor(0, 0, 0, 0))
-        qpainterMask = QPainter(maskImg)
-        qpainterMask.drawImage(self.merge.transformX,
-                               self.merge.transformY,
-                               scaledMaskImg.scaledToWidth(self.merge.scaleX + scaledMaskImg.size().width()))
-        qpainterMask.end()
-
-        source = convertQ2N(self.merge.bgImage)
-        target = convertQ2N(targetImg)
-        mask = convertQ2N(maskImg)
-
-        maskBool = mask[:,:,1] == 255
-        result = poisson_edit(source, target, maskBool)
+        key = cacheKey('poisson', q2a.raw_view(self.merge.bgImage), q2a.raw_view(self.scribble.bgImage),
+                       q2a.raw_view(self.insertMask), self.merge.transformScale.m11(),
+                       self.merge.transformScale.m22(), self.merge.transformX, self.merge.transformY, self.merge.scaleX, POISSON_SOLVER)
+        result = resultCache.get(key)
+        if result is not None:
+            self.onBlended(result)
+            self.showCacheMessage('Poisson edit')
+            return
 
-        finalImg = convertN2Q(result)
+        with span('applyPoisson.placeInsert'):
+            targetImg, maskImg = placeInsert(self.scribble.bgImage, self.insertMask,
+                                             self.merge.bgWidth, self.merge.bgHeight,
+                                             self.merge.transformScale, self.merge.transformX,
+                                             self.merge.transformY, self.merge.scaleX)
+
+        with span('applyPoisson.convert', image=self.merge.bgImage):
+            source = convertQ2N(self.merge.bgImage).copy()
+            target = convertQ2N(targetImg).copy()
+            mask = convertQ2N(maskImg)
+
+            maskBool = mask[:,:,1] == 255
+        # Its own warm start: the live preview solves with another solver,
+        # whose operator would evict this one's factorization every time.
+        info = {}
+        worker = Worker(poisson_edit, source, target, maskBool, POISSON_SOLVER, info,
+                        warmStart=self.merge.warmStart(1, POISSON_SOLVER),
+                        progressFormat='Poisson solve iteration {0}, residual {1:.2e}')
+        # Stored as 8 bit, which is all convertN2Q keeps of the result anyway.
+        worker.signals.finished.connect(
+            lambda result: resultCache.put(key, np.clip(result, 0, 255).astype(np.uint8)))
+
+        # Connected by startWorker, before the worker starts and after the
+        # status bar is cleared, so the message is neither missed nor wiped.
+        def onFinished(result):
+            self.onBlended(result)
+            self.showSolveMessage(info)
+        self.startWorker(worker, onFinished, 'Error in Poisson edit')
+
+    def onBlended(self, result):
+        self.merge.addEdit(self.scribble.path, self.scribble.bgImage, self.insertMask)
+        with span('applyPoisson.convertResult', result=result):
+            finalImg = convertN2Q(result)
         self.merge.applyResult(finalImg)
 
-        self.tbSaveImage.triggered.connect(self.saveImage)
         self.tbSaveImage.setVisible(True)
 
+    def showSolveMessage(self, info: dict):
+        reuse = [name for name, used in (('warm start', info['warm']),
+                                         ('reused factorization', info['reusedOperator'])) if used]
+        self.statusBar().showMessage(f"Poisson edit ({info['solver']}, {', '.join(reuse) or 'cold'}): "
+                                     f"{info['iterations']} iterations in {info['solveTime'] * 1000:.0f} ms", 5000)
+
+    def showCacheMessage(self, stage: str):
+        stats = resultCache.stats()
+        self.statusBar().showMessage(f"{stage}: cached result ({stats['hits']} hits, "
+                                     f"{stats['misses']} misses)", 5000)
+
+    def startWorker(self, worker: Worker, onFinished, errorMsg: str):
+        self.worker = worker
+        worker.signals.progress.connect(self.statusBar().showMessage)
+        worker.signals.finished.connect(self.onWorkerDone)
+        worker.signals.error.connect(self.onWorkerDone)
+        worker.signals.cancelled.connect(self.onWorkerDone)
+        worker.signals.finished.connect(onFinished)
+        worker.signals.error.connect(lambda e: self.showErrorWindow(errorMsg, e))
+        worker.signals.cancelled.connect(lambda: self.statusBar().showMessage('Cancelled', 3000))
+
+        self.setBusy(True)
+        QThreadPool.globalInstance().start(worker)
+
+    def onWorkerDone(self):
+        self.worker = None
+        self.statusBar().clearMessage()
+        self.setBusy(False)
+
+    def cancelWorker(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def setBusy(self, busy: bool):
+        # Inputs stay locked while a job reads from the images.
+        self.tbCancel.setVisible(busy)
+        self.backendBox.setEnabled(not busy)
+        for action in (self.tbImportScribble, self.tbImportMerge, self.tbSuperpixels, self.tbTrain,
+                       self.tbApplyMask, self.tbPoissonEdit, self.tbLivePreview, self.tbSaveImage):
+            action.setEnabled(not busy)
+        for widget in (self.scribble, self.merge):
+            if widget is not None:
+                widget.setEnabled(not busy)
+
+    def closeEvent(self, ev):
+        self.cancelWorker()
+        if self.merge is not None:
+            self.merge.cancelPreview()
+        QThreadPool.globalInstance().waitForDone()
+        return super().closeEvent(ev)
+
     def saveImage(self):
+        if self.worker is not None or self.merge is None:
+            return
         path, _ = QFileDialog.getSaveFileName(self, "Save Image", "result.png", "PNG (*.png)")
-        self.merge.bgImage.save(path)
+        if not path:
+            return
+        # The full-resolution composite is only computed here.
+        worker = Worker(self.merge.compositeFullResolution,
+                        progressFormat='Full resolution solve iteration {0}, residual {1:.2e}')
+        self.startWorker(worker, lambda img: img.save(path), 'Error saving image')
 
     def showErrorWindow(self, msg: str, err: Exception):
         dlg = QMessageBox(self)
@@ -1,31 +1,56 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+import qimage2ndarray as q2a
+
 from PySide6.QtWidgets import QLabel
-from PySide6.QtGui import QImage, QColor, QPixmap, QPainter, QMouseEvent, QTransform, QCursor
-from PySide6.QtCore import QPointF, Qt
+from PySide6.QtGui import QImage, QImageReader, QColor, QPixmap, QPainter, QMouseEvent, QTransform, QCursor
+from PySide6.QtCore import QPointF, QRect, QRectF, QSize, Qt, QThreadPool
 from PySide6.QtWidgets import QApplication
 
-from src.utils import plotQImage, trimImage
+from src.tiles import TiledImage, compositeTiled, loadPreview, loadRegion
+from src.tracing import span
+from src.utils import (TRIM_PADDING, PoissonWarmStart, convertQ2N, convertN2Q, maskBounds, plotQImage,
+                       poisson_edit, trimImage, upsampleMask)
+from src.worker import Worker
+
+FULL_RESOLUTION_SOLVER = 'multigrid'
+SCALE_CACHE_SIZE = 16
+# Live preview: solved at 1/PREVIEW_SCALE while dragging, at preview
+# resolution once the mouse is released. The solver is an iterative one so
+# that a superseded solve stops at its next iteration.
+PREVIEW_SCALE = 4
+PREVIEW_SOLVER = 'multigrid'
+PREVIEW_PADDING = 8
 
 class Merge(QLabel):
     def __init__(self, path):
         super(Merge, self).__init__()
-        self.bgImage = QImage(path, format=QImage.Format.Format_ARGB32)
+        # All interaction happens on a preview scaled to fit the screen, the
+        # only resolution that is decoded up front. The original resolution
+        # is read tile by tile from path for the final result.
+        self.path = path
+        self.fullSize = QImageReader(path).size()
         yAvail = QApplication.primaryScreen().availableGeometry().height()
         xAvail = QApplication.primaryScreen().availableGeometry().width() / 2
-        if self.bgImage.height() > yAvail or self.bgImage.width() > xAvail:
-            self.bgImage = self.bgImage.scaled(xAvail - 100, yAvail - 100, Qt.AspectRatioMode.KeepAspectRatio)
+        maxSize = self.fullSize
+        if self.fullSize.height() > yAvail or self.fullSize.width() > xAvail:
+            maxSize = QSize(int(xAvail - 100), int(yAvail - 100))
+        self.bgImage = loadPreview(path, maxSize)
         self.bgWidth = self.bgImage.width()
         self.bgHeight = self.bgImage.height()
 
-        self.image = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
-        self.image.fill(QColor(0, 0, 0, 0))
-        self.setPixmap(QPixmap.fromImage(self.image))
+        self.bgPixmap = QPixmap.fromImage(self.bgImage)
         self.setFixedSize(self.bgWidth, self.bgHeight)
 
-        self.insertImg = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
+        self.setInsert(QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32))
         self.insertImg.fill(QColor(0, 0, 0, 0))
 
         self.originalImg = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
         self.originalImg.fill(QColor(0, 0, 0, 0))
+        self.mipLevels = []
+        self.scaleCache = OrderedDict()
 
         self.transformX = 0
         self.transformY = 0
@@ -35,31 +60,92 @@ class Merge(QLabel):
         self.isEdit = False
         self.isScaling = False
         self.lastCursorPos = QPointF()
+        self.scaleHighlight = False
+        self.dirtyRect = QRect()
 
         self.mousePressed = False
         self.setMouseTracking(True)
 
+        # Poisson edits applied to the preview, replayed at full resolution on save
+        self.edits = []
+
+        # Live Poisson preview of the insert; only the newest request counts.
+        self.livePreview = False
+        self.previewPixmap = None
+        self.previewWorker = None
+        self.previewPending = None
+        self.previewGeneration = 0
+        # Poisson warm starts per preview factor and solver, so the coarse
+        # solves while dragging do not evict the factorization of the full
+        # ones, nor the preview's solver that of Poisson Edit's.
+        self.warmStarts = {}
+
         self.render()
 
     def render(self, scaleHighlight = False):
-        self.image.fill(QColor(0, 0, 0, 0))
-        qpainter = QPainter(self.image)
-        qpainter.drawImage(0, 0, self.bgImage)
+        # Only the area the insert covered before and covers now is repainted.
+        self.scaleHighlight = scaleHighlight
+        insertRect = QRect()
+        if self.isEdit:
+            insertRect = QRectF(self.transformX, self.transformY, self.insertImg.width(),
+                                self.insertImg.height()).toAlignedRect().adjusted(-2, -2, 3, 3)
+        self.update(insertRect.united(self.dirtyRect))
+        self.dirtyRect = insertRect
+
+    def paintEvent(self, ev):
+        qpainter = QPainter(self)
+        qpainter.drawPixmap(ev.rect(), self.bgPixmap, ev.rect())
         if self.isEdit:
             transform = QTransform()
             qpainter.setTransform(transform.translate(self.transformX, self.transformY))
-            qpainter.drawImage(0, 0, self.insertImg)
+            # A preview solved for an earlier position follows the insert
+            # until the newer one arrives, as long as the size still matches.
+            if self.previewPixmap is not None and self.previewPixmap.size() == self.insertImg.size():
+                qpainter.drawPixmap(0, 0, self.previewPixmap)
+            else:
+                qpainter.drawPixmap(0, 0, self.insertPixmap)
 
-            if scaleHighlight:
+            if self.scaleHighlight:
                 pen = qpainter.pen()
                 pen.setWidth(3)
                 pen.setColor(QColor('#FFFFFF'))
                 qpainter.setPen(pen)
             qpainter.drawRect(0, 0, self.insertImg.size().width() ,self.insertImg.size().height())
-        self.setPixmap(QPixmap.fromImage(self.image))
+        qpainter.end()
+
+    def setInsert(self, img: QImage):
+        self.insertImg = img
+        self.insertPixmap = QPixmap.fromImage(img)
+
+    def scaledInsert(self, width: int) -> QImage:
+        # Scaled inserts come from the smallest mip level that is still at
+        # least as wide, and recent widths are kept in a small LRU cache.
+        width = max(1, int(width))
+        if width in self.scaleCache:
+            self.scaleCache.move_to_end(width)
+            return self.scaleCache[width]
+
+        if not self.mipLevels:
+            self.mipLevels = [self.originalImg]
+            while self.mipLevels[-1].width() >= 64:
+                self.mipLevels.append(self.mipLevels[-1].scaled(
+                    self.mipLevels[-1].width() // 2, self.mipLevels[-1].height() // 2,
+                    Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation))
+        level = self.mipLevels[0]
+        for mip in self.mipLevels:
+            if mip.width() >= width:
+                level = mip
+        height = max(1, round(self.originalImg.height() * width / self.originalImg.width()))
+        scaled = level.scaled(width, height)
+
+        self.scaleCache[width] = scaled
+        if len(self.scaleCache) > SCALE_CACHE_SIZE:
+            self.scaleCache.popitem(last=False)
+        return scaled
 
     def paste(self, img: QImage):
-        img = trimImage(img, img)
+        with span('paste.trim', image=img):
+            img = trimImage(img, img)
         imgX = img.size().width()
         imgY = img.size().height()
         targetX = self.insertImg.size().width()
@@ -81,21 +167,200 @@ class Merge(QLabel):
             img = img.transformed(self.transformScale)
 
         self.originalImg = img
-        self.insertImg = self.originalImg.copy()
+        self.mipLevels = []
+        self.scaleCache = OrderedDict()
+        self.setInsert(self.originalImg.copy())
 
         self.isEdit = True
         self.setCursor(QCursor(Qt.CursorShape.OpenHandCursor))
 
+        self.clearPreview()
+        self.requestPreview(1)
+
+    def setLivePreview(self, enabled: bool):
+        self.livePreview = enabled
+        self.clearPreview()
+        if enabled:
+            self.requestPreview(1)
+
+    def clearPreview(self):
+        # Results still in flight belong to an older generation and are dropped.
+        self.previewGeneration += 1
+        self.previewPending = None
+        self.previewPixmap = None
+        if self.previewWorker is not None:
+            self.previewWorker.cancel()
         self.render()
 
+    def cancelPreview(self):
+        # Unlike clearPreview, detaches the running solve: it stops at its
+        # next iteration and its result reaches neither this widget nor a
+        # pending request, which also makes the widget safe to delete.
+        self.previewPending = None
+        worker = self.previewWorker
+        if worker is None:
+            return
+        self.previewWorker = None
+        for signal in (worker.signals.finished, worker.signals.error, worker.signals.cancelled):
+            signal.disconnect()
+        worker.cancel()
+
+    def requestPreview(self, factor: int = PREVIEW_SCALE):
+        if not (self.livePreview and self.isEdit):
+            return
+        self.previewGeneration += 1
+        if self.previewWorker is not None:
+            # Only the latest request is kept; it starts once the running
+            # solve finishes or notices the cancellation.
+            self.previewPending = factor
+            self.previewWorker.cancel()
+            return
+        self.startPreview(factor)
+
+    def startPreview(self, factor: int):
+        insertRect = QRect(int(self.transformX), int(self.transformY),
+                           self.insertImg.width(), self.insertImg.height())
+        roi = insertRect.adjusted(-PREVIEW_PADDING, -PREVIEW_PADDING,
+                                  PREVIEW_PADDING, PREVIEW_PADDING).intersected(self.bgImage.rect())
+        if roi.isEmpty():
+            return
+
+        insertCanvas = QImage(roi.size(), QImage.Format.Format_ARGB32)
+        insertCanvas.fill(QColor(0, 0, 0, 0))
+        painter = QPainter(insertCanvas)
+        painter.drawImage(insertRect.topLeft() - roi.topLeft(), self.insertImg)
+        painter.end()
+
+        background = self.bgImage.copy(roi)
+        width = max(1, roi.width() // factor)
+        height = max(1, roi.height() // factor)
+        if factor > 1:
+            background = background.scaled(width, height, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                           Qt.TransformationMode.SmoothTransformation)
+            insertCanvas = insertCanvas.scaled(width, height, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                               Qt.TransformationMode.SmoothTransformation)
+        source = convertQ2N(background).copy()
+        target = convertQ2N(insertCanvas).copy()
+        mask = q2a.alpha_view(insertCanvas) >= 128
+
+        generation = self.previewGeneration
+        worker = Worker(previewBlend, source, target, mask, self.warmStart(factor))
+        worker.signals.finished.connect(
+            lambda result: self.onPreview(result, generation, roi, insertRect))
+        worker.signals.finished.connect(self.onPreviewDone)
+        worker.signals.error.connect(self.onPreviewDone)
+        worker.signals.cancelled.connect(self.onPreviewDone)
+        self.previewWorker = worker
+        QThreadPool.globalInstance().start(worker)
+
+    def onPreview(self, result, generation: int, roi: QRect, insertRect: QRect):
+        if generation != self.previewGeneration or insertRect.size() != self.insertImg.size():
+            return
+        blended = convertN2Q(result).scaled(roi.size(), Qt.AspectRatioMode.IgnoreAspectRatio,
+                                            Qt.TransformationMode.SmoothTransformation)
+        preview = blended.copy(QRect(insertRect.topLeft() - roi.topLeft(), insertRect.size()))
+        preview = preview.convertToFormat(QImage.Format.Format_ARGB32)
+        # The insert's own alpha keeps the upsampled background out of the preview.
+        q2a.alpha_view(preview)[:] = q2a.alpha_view(self.insertImg)
+        self.previewPixmap = QPixmap.fromImage(preview)
+        self.render(self.scaleHighlight)
+
+    def onPreviewDone(self, *args):
+        self.previewWorker = None
+        if self.previewPending is not None:
+            factor = self.previewPending
+            self.previewPending = None
+            self.startPreview(factor)
+
+    def warmStart(self, factor: int = 1, solver: str = PREVIEW_SOLVER) -> PoissonWarmStart:
+        return self.warmStarts.setdefault((factor, solver), PoissonWarmStart())
+
     def applyResult(self, result: QImage):
         self.bgImage = result
+        self.bgPixmap = QPixmap.fromImage(self.bgImage)
         self.reset()
+        self.clearPreview()
         self.render()
+        self.update()
+
+    def addEdit(self, path: str, previewImage: QImage, maskImage: QImage):
+        # The insert is kept as the preview it was cut from; its original
+        # resolution is only read, around the object, by compositeFullResolution.
+        self.edits.append({
+            'path': path,
+            'fullSize': QImageReader(path).size(),
+            'previewImage': previewImage,
+            'mask': maskImage.copy(),
+            'transform': QTransform(self.transformScale),
+            'x': self.transformX,
+            'y': self.transformY,
+            'scaleX': self.scaleX,
+        })
+
+    def compositeFullResolution(self, callback=None):
+        # Returns the preview itself when nothing was scaled, otherwise a
+        # TiledImage; both save() to a file.
+        if self.fullSize == self.bgImage.size() and all(
+                edit['fullSize'] == edit['previewImage'].size() for edit in self.edits):
+            return self.bgImage
+
+        scale = self.fullSize.width() / self.bgWidth
+        result = TiledImage.fromFile(self.path)
+
+        for edit in self.edits:
+            # Upsample the preview segmentation to the scribble image's full
+            # resolution and scale the insert so it covers the same area of
+            # the full-resolution background as it did in the preview.
+            previewTrim = trimImage(edit['previewImage'], edit['mask'])
+            previewWidth = previewTrim.transformed(edit['transform']).width() + edit['scaleX']
+
+            previewMask = convertQ2N(edit['mask'])[:,:,1] == 255
+            previewBounds = maskBounds(q2a.alpha_view(edit['mask']) > 0, TRIM_PADDING)
+            if previewBounds is None:
+                continue
+            fullHeight, fullWidth = edit['fullSize'].height(), edit['fullSize'].width()
+            ratio = fullWidth / edit['previewImage'].width()
+
+            # Only the object's neighbourhood is upsampled and read at full
+            # resolution. The mask cannot reach past the upsampled preview
+            # bounds by more than a pixel, so a margin of TRIM_PADDING + 2
+            # leaves the padded crop the same as on the whole image.
+            margin = TRIM_PADDING + 2
+            region = tuple(slice(max(0, math.floor(bounds.start * ratio) - margin),
+                                 min(size, math.ceil(bounds.stop * ratio) + margin))
+                           for bounds, size in zip(maskBounds(previewMask), (fullHeight, fullWidth)))
+            regionBool = upsampleMask(previewMask, fullHeight, fullWidth, region)
+            cropBounds = maskBounds(regionBool, TRIM_PADDING)
+            if cropBounds is None:
+                continue
+            cropBool = regionBool[cropBounds]
+            cropMask = QImage(cropBool.shape[1], cropBool.shape[0], QImage.Format.Format_ARGB32)
+            cropMask.fill(QColor(0, 0, 0, 0))
+            q2a.raw_view(cropMask)[cropBool] = 0xFF00FF00
+            fullStartY = region[0].start + cropBounds[0].start
+            fullStartX = region[1].start + cropBounds[1].start
+            crop = loadRegion(edit['path'], QRect(fullStartX, fullStartY, cropBool.shape[1], cropBool.shape[0]))
+
+            # Both trims pad the mask by TRIM_PADDING pixels of their own
+            # resolution, so the crops differ by more than the scale. Map
+            # image to image instead: a preview pixel p lands at
+            # x + (p - previewStart) * previewFactor, a full-resolution pixel
+            # q = p * ratio at fullX + (q - fullStart) * factor.
+            previewFactor = previewWidth / previewTrim.width()
+            factor = previewFactor * scale / ratio
+            fullX = (edit['x'] - previewBounds[1].start * previewFactor) * scale + fullStartX * factor
+            fullY = (edit['y'] - previewBounds[0].start * previewFactor) * scale + fullStartY * factor
+
+            # Only the tiles under the insert are read, blended and written back.
+            compositeTiled(result, crop, cropMask, QTransform().scale(factor, factor),
+                           round(fullX), round(fullY), 0, FULL_RESOLUTION_SOLVER, callback)
+
+        return result
 
     def reset(self):
+        self.cancelPreview()
         self.setCursor(QCursor(Qt.CursorShape.ArrowCursor))
-        self.insertImg = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
+        self.setInsert(QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32))
         self.insertImg.fill(QColor(0, 0, 0, 0))
         self.transformX = 0
         self.transformY = 0
@@ -120,9 +385,10 @@ class Merge(QLabel):
         if self.isScaling and self.mousePressed:
             self.scaleX = self.scaleX + distanceX
             self.scaleY = self.scaleY + distanceY
-            self.insertImg = self.originalImg.scaledToWidth(self.originalImg.size().width() + self.scaleX)
+            self.setInsert(self.scaledInsert(self.originalImg.size().width() + self.scaleX))
             self.lastCursorPos = ev.position()
             self.render(scaleHighlight=True)
+            self.requestPreview()
 
             return super().mouseMoveEvent(ev)
         elif self.mousePressed:
@@ -130,6 +396,7 @@ class Merge(QLabel):
             self.transformY += distanceY
             self.lastCursorPos = ev.position()
             self.render()
+            self.requestPreview()
             return super().mouseMoveEvent(ev)
 
         
@@ -142,7 +409,12 @@ class Merge(QLabel):
         bottomBound = (self.transformX + insertX + 2 >= point.x() >= self.transformX - 2 and
                      self.transformY + insertY + 2 >= point.y() >= self.transformY + insertY - 2)
 
-        if rightBound and bottomBound:
+        # Plain hover only repaints when the highlight actually changes.
+        highlight = rightBound and bottomBound
+        if highlight == self.scaleHighlight:
+            return super().mouseMoveEvent(ev)
+
+        if highlight:
             self.setCursor(QCursor(Qt.CursorShape.SizeFDiagCursor))
             self.render(scaleHighlight=True)
         # elif leftBound or rightBound:
@@ -191,7 +463,16 @@ class Merge(QLabel):
     def mouseReleaseEvent(self, ev: QMouseEvent):
         if self.isEdit:
             self.setCursor(QCursor(Qt.CursorShape.OpenHandCursor))
+            self.render()
+            if self.mousePressed:
+                self.requestPreview(1)
 
         self.isScaling = False
         self.mousePressed = False
-        return super().mouseReleaseEvent(ev)
\ No newline at end of file
+        return super().mouseReleaseEvent(ev)
+
+
+def previewBlend(source: np.ndarray, target: np.ndarray, mask: np.ndarray,
+                 warmStart: PoissonWarmStart = None, callback=None) -> np.ndarray:
+    return np.clip(poisson_edit(source, target, mask, PREVIEW_SOLVER, callback=callback,
+                                warmStart=warmStart), 0, 255)
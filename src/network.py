@@ -1,67 +1,272 @@
+import copy
+import math
+import os
+import time
+
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.data import BatchSampler, DataLoader, TensorDataset, WeightedRandomSampler
 from numpy import ndarray
 
+from src.tracing import span
+from src.tiles import featureChunks, probabilityMap
+
 # Hyperparameters
 HIDDEN_LAYER_1 = 16
 HIDDEN_LAYER_2 = 32
 LEARNING_RATE = 0.01
+BATCH_SIZE = 4096
+MAX_EPOCHS = 1000
+PATIENCE = 25
+MIN_DELTA = 1e-4
+VALIDATION_SPLIT = 0.1
+STALL_EPOCHS = 10
+MAX_RETRIES = 3
+FINETUNE_EPOCHS = 50
+TRAIN_THREADS = os.cpu_count()
+CHUNK_SIZE = 65536
 
 class Network(nn.Module):
-    def __init__(self, input_size: int, n_hidden1: int, n_hidden2: int):
+    def __init__(self, input_size: int, n_hidden1: int, n_hidden2: int, output_size: int = 2):
         super(Network, self).__init__()
 
-        output_size = 1
+        # One output per scribble class, background first.
         self.fc1 = nn.Linear(input_size, n_hidden1)
         self.fc2 = nn.Linear(n_hidden1, n_hidden2)
         self.fc3 = nn.Linear(n_hidden2, output_size)
 
-    def forward(self, x):
+    def logits(self, x):
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
-        return torch.sigmoid(self.fc3(x))
+        return self.fc3(x)
+
+    def forward(self, x):
+        return torch.softmax(self.logits(x), dim=1)
     
-def train(data: ndarray, labels: ndarray, img: ndarray) -> ndarray:
-    device=torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"Training using {device}")
+def splitValidation(labels: torch.Tensor):
+    # Stratified hold-out so every scribble class is validated.
+    trainIdx = []
+    valIdx = []
+    for cls in torch.unique(labels):
+        idx = torch.nonzero(labels == cls).squeeze(1)
+        idx = idx[torch.randperm(idx.shape[0], device=idx.device)]
+        nVal = int(idx.shape[0] * VALIDATION_SPLIT)
+        valIdx.append(idx[:nVal])
+        trainIdx.append(idx[nVal:])
+    return torch.cat(trainIdx), torch.cat(valIdx)
+
+def classWeights(labels: torch.Tensor, classes: int) -> torch.Tensor:
+    # Inverse class frequency, so every class present counts the same in the loss.
+    counts = torch.bincount(labels, minlength=classes).float()
+    return torch.where(counts > 0, 1.0 / counts.clamp(min=1), torch.zeros_like(counts))
+
+def balancedLoss(net: Network, data: torch.Tensor, labels: torch.Tensor) -> float:
+    net.eval()
+    with torch.no_grad():
+        return F.cross_entropy(net.logits(data), labels,
+                               weight=classWeights(labels, net.fc3.out_features)).item()
+
+def batches(tData: torch.Tensor, tLabels: torch.Tensor, trainIdx: torch.Tensor, batchSize: int,
+            classes: int = 2):
+    # Returns the batches and the class weights of their loss. A single
+    # batch is gathered once and balanced by the weights; otherwise every
+    # batch is gathered from the full tensors, so the training rows are never
+    # copied as a whole, and balanced by the sampler.
+    if batchSize is None or batchSize >= trainIdx.shape[0]:
+        trainLabels = tLabels[trainIdx]
+        return [(tData[trainIdx], trainLabels)], classWeights(trainLabels, classes)
+
+    # Class-balanced sampling of the training rows: each class is drawn with
+    # equal probability, the validation rows never.
+    trainLabels = tLabels[trainIdx]
+    counts = torch.bincount(trainLabels, minlength=2).float()
+    weights = torch.zeros(tLabels.shape[0], device=tLabels.device)
+    weights[trainIdx] = (1.0 / counts.clamp(min=1))[trainLabels]
+    sampler = BatchSampler(WeightedRandomSampler(weights.cpu(), trainIdx.shape[0], replacement=True),
+                           batchSize, drop_last=False)
+    return DataLoader(TensorDataset(tData, tLabels), sampler=sampler, batch_size=None), None
+
+def fit(tData, tLabels, trainIdx, valData, valLabels, batchSize: int, device, callback=None,
+        net: Network = None, optimizer=None, maxEpochs: int = MAX_EPOCHS, classes: int = 2):
+    # Trains on the rows trainIdx of tData and tLabels.
+    fresh = net is None
+    if fresh:
+        net = Network(5, HIDDEN_LAYER_1, HIDDEN_LAYER_2, classes).to(device)
+        optimizer = optim.Adam(net.parameters(), lr = LEARNING_RATE)
+    loader, weight = batches(tData, tLabels, trainIdx, batchSize, net.fc3.out_features)
+
+    firstLoss = None
+    bestLoss = math.inf
+    bestState = copy.deepcopy(net.state_dict())
+    badEpochs = 0
+    lastLoss = None
+    unchanged = 0
+    stopReason = 'max-epochs'
+
+    # Training loop
+    for epoch in range(maxEpochs):
+        net.train()
+        for batchData, batchLabels in loader:
+            optimizer.zero_grad()
+            # Cross-entropy on the logits, the stable form of the softmax loss.
+            loss = F.cross_entropy(net.logits(batchData), batchLabels, weight=weight)
+            loss.backward()
+            optimizer.step()
+
+        lossValue = loss.item()
+        valLoss = balancedLoss(net, valData, valLabels)
+
+        if epoch % 100 == 0:
+            print(f"Training loss after epoch {epoch}: {lossValue}")
+        if callback is not None:
+            callback(epoch, lossValue)
+
+        if firstLoss is None:
+            firstLoss = valLoss
+        if valLoss < bestLoss - MIN_DELTA:
+            bestLoss = valLoss
+            bestState = copy.deepcopy(net.state_dict())
+            badEpochs = 0
+        else:
+            badEpochs += 1
+        if badEpochs >= PATIENCE:
+            stopReason = 'plateau'
+            break
+
+        unchanged = unchanged + 1 if lossValue == lastLoss else 0
+        lastLoss = lossValue
+        if unchanged >= STALL_EPOCHS:
+            stopReason = 'converged'
+            break
+
+    # Whatever stopped it, a fresh network that never got 1% below its first
+    # validation loss died before learning anything; that is what is retried.
+    if fresh and bestLoss >= 0.99 * firstLoss:
+        stopReason = 'stalled'
+
+    net.load_state_dict(bestState)
+    return net, bestLoss, epoch + 1, stopReason, optimizer
 
-    net = Network(5, HIDDEN_LAYER_1, HIDDEN_LAYER_2).to(device)
+def predict(net: Network, img: ndarray, device, chunkSize: int = CHUNK_SIZE) -> ndarray:
+    # img is an (H, W, 3) image, a TiledImage or an (N, 5) feature matrix;
+    # the result has one probability per class in its last axis.
+    classes = net.fc3.out_features
+    if img.ndim == 2:
+        chunks = ((slice(row, row + chunkSize), img[row:row + chunkSize].astype(np.float32, copy=False))
+                  for row in range(0, img.shape[0], chunkSize))
+        probabilities = np.empty((img.shape[0], classes), dtype=np.float32)
+    else:
+        chunks = featureChunks(img, chunkSize)
+        probabilities = probabilityMap(img, classes)
+
+    net.eval()
+    with torch.no_grad():
+        for rows, features in chunks:
+            predicted = net(torch.from_numpy(features).to(device))
+            probabilities[rows] = predicted.cpu().numpy().reshape(probabilities[rows].shape)
+    return probabilities
+
+def toTensors(data: ndarray, labels: ndarray, device):
+    # float32 features (see getPixelData) are shared with the tensor, not
+    # copied. Training gathers its batches through trainIdx; only the
+    # validation rows are copied out.
     tData = torch.from_numpy(data).float()
-    tLabels = torch.from_numpy(labels).float()
+    tLabels = torch.from_numpy(labels).long()
     if device.type == 'cuda':
             tData = tData.cuda()
             tLabels = tLabels.cuda()
+    return tData, tLabels
 
-    optimizer = optim.Adam(net.parameters(), lr = LEARNING_RATE)
+def splitTensors(tData: torch.Tensor, tLabels: torch.Tensor):
+    trainIdx, valIdx = splitValidation(tLabels)
+    if valIdx.shape[0] == 0:
+        valIdx = trainIdx
+    return trainIdx, tData[valIdx], tLabels[valIdx]
 
-    lastLoss = 0
-    lossCounter = 10
+def fitFresh(tData: torch.Tensor, tLabels: torch.Tensor, batchSize: int, device, callback, classes: int):
+    # New networks until one learns something, at most MAX_RETRIES.
+    trainIdx, valData, valLabels = splitTensors(tData, tLabels)
+    best = None
+    epochs = 0
+    for attempt in range(1, MAX_RETRIES + 1):
+        result = fit(tData, tLabels, trainIdx, valData, valLabels, batchSize, device, callback,
+                     classes=classes)
+        epochs += result[2]
+        if best is None or result[1] < best[1]:
+            best = result
+        if result[3] != 'stalled':
+            break
+    return best, epochs, attempt
 
-    # Training loop
-    for epoch in range(1000):
-        optimizer.zero_grad()
-        predict = net(tData)
-        loss = F.binary_cross_entropy(predict.squeeze(), tLabels)
-        loss.backward()
-        if loss.item() == lastLoss:
-            if lossCounter == 0:
-                return train(data, labels, img)
-            lossCounter -= 1
-        lastLoss = loss.item()
-        optimizer.step()
-        if epoch % 100 == 0:
-            print(f"Training loss after epoch {epoch}: {loss.item()}")
+def train(data: ndarray, labels: ndarray, img: ndarray, callback=None,
+          batchSize: int = BATCH_SIZE, chunkSize: int = CHUNK_SIZE, info: dict = None,
+          model: dict = None, classes: int = None, validation: tuple = None) -> ndarray:
+    # validation is (data, labels) of every scribble so far; a warm start
+    # has to do at least as well on it as the cached network did.
+    device=torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"Training using {device}")
+    torch.set_num_threads(TRAIN_THREADS)
+    start = time.perf_counter()
+
+    # Labels are class indices, background 0; classes defaults to the
+    # highest one present.
+    if classes is None:
+        classes = max(2, int(labels.max()) + 1)
+
+    tData, tLabels = toTensors(data, labels, device)
+
+    epochs = 0
+    attempt = 0
+    warmStart = model is not None and 'net' in model and model['net'].fc3.out_features == classes
+    with span('train.fit', samples=int(tData.shape[0]), warmStart=warmStart) as trainSpan:
+        if warmStart and tData.shape[0] == 0:
+            # Nothing new to learn: the cached network is used as it is.
+            net = model['net']
+            optimizer = None
+            valLoss = balancedLoss(net, *toTensors(*validation, device)) if validation is not None else math.nan
+            stopReason = 'cached'
+        else:
+            best = None
+            if warmStart:
+                # Warm start: fine-tune a copy of the cached network, so a cancelled
+                # run leaves the cache untouched.
+                net = copy.deepcopy(model['net']).to(device)
+                optimizer = optim.Adam(net.parameters(), lr = LEARNING_RATE)
+                optimizer.load_state_dict(copy.deepcopy(model['optimizer']))
+                best = fit(tData, tLabels, *splitTensors(tData, tLabels), batchSize, device, callback,
+                           net, optimizer, FINETUNE_EPOCHS)
+                epochs = best[2]
+                attempt = 1
+                if validation is not None:
+                    vData, vLabels = toTensors(*validation, device)
+                    if balancedLoss(best[0], vData, vLabels) > balancedLoss(model['net'], vData, vLabels):
+                        # The fine-tune lost more than it learned; start over
+                        # on every scribble instead.
+                        print("Fine-tuning made the fit worse, retraining.")
+                        tData, tLabels = vData, vLabels
+                        warmStart = False
+                        best = None
+            if best is None:
+                best, fresh, attempt = fitFresh(tData, tLabels, batchSize, device, callback, classes)
+                epochs += fresh
+            net, valLoss, _, stopReason, optimizer = best
+        trainSpan.set(epochs=epochs, stopReason=stopReason, warmStart=warmStart)
+    if model is not None and optimizer is not None:
+        model.update(net=net, optimizer=optimizer.state_dict())
+    trainTime = time.perf_counter() - start
     print("Training finished.")
 
     # Input full image in trained network
-    net.eval()
-    img = torch.from_numpy(img).float()
-    with torch.no_grad():
-        if device.type == 'cuda':
-            img = img.cuda()
-        eval = net(img)
-        if device.type == 'cuda':
-            eval = eval.cpu()
-    return eval.numpy()
+    start = time.perf_counter()
+    with span('train.predict', image=img):
+        probabilities = predict(net, img, device, chunkSize)
+
+    if info is not None:
+        info.update(device=device.type, threads=torch.get_num_threads(), samples=int(tData.shape[0]),
+                    batchSize=batchSize, classes=classes, warmStart=warmStart, attempts=attempt, epochs=epochs, stopReason=stopReason,
+                    validationLoss=valLoss, trainTime=trainTime,
+                    inferenceTime=time.perf_counter() - start)
+    return probabilities
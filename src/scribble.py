@@ -1,43 +1,68 @@
 import numpy as np
+import qimage2ndarray as q2a
 
 from PySide6.QtWidgets import QLabel
-from PySide6.QtGui import QImage, QColor, QPixmap, QPainter, QMouseEvent, QPen
-from PySide6.QtCore import QLine, QPointF, Qt
+from PySide6.QtGui import QImage, QImageReader, QColor, QPixmap, QPainter, QMouseEvent, QPen
+from PySide6.QtCore import QLine, QPointF, QRect, QSize, Qt, QTimer
 
 from PySide6.QtWidgets import QApplication
 
-from src.network import train
-from src.utils import convertQ2N, getPixelData
+from src.cache import cacheKey, resultCache
+from src.segmentation import createBackend
+from src.superpixel import slic, superpixelFeatures
+from src.tiles import loadPreview
+from src.tracing import span
+from src.utils import SCRIBBLE_PALETTE, convertQ2N, getPixelData, scribbleLabels, segmentLabels
 
+# Old scribble pixels replayed alongside new strokes when fine-tuning
+REPLAY_SIZE = 2048
+# Pen colors of the segmentation classes, background first
+PALETTE = [QColor(*color) for color in SCRIBBLE_PALETTE]
 
 
 class Scribble(QLabel):
     def __init__(self, path):
         super(Scribble, self).__init__()
-        self.bgImage = QImage(path, format=QImage.Format.Format_ARGB32)
+        # All interaction happens on a preview scaled to fit the screen, the
+        # only resolution that is decoded up front. The original resolution
+        # is read from path, around the object only, for the final result.
+        self.path = path
+        self.fullSize = QImageReader(path).size()
         yAvail = QApplication.primaryScreen().availableGeometry().height()
         xAvail = QApplication.primaryScreen().availableGeometry().width() / 2
-        if self.bgImage.height() > yAvail or self.bgImage.width() > xAvail:
-            self.bgImage = self.bgImage.scaled(xAvail - 100, yAvail - 100, Qt.AspectRatioMode.KeepAspectRatio)
+        maxSize = self.fullSize
+        if self.fullSize.height() > yAvail or self.fullSize.width() > xAvail:
+            maxSize = QSize(int(xAvail - 100), int(yAvail - 100))
+        self.bgImage = loadPreview(path, maxSize)
         self.bgWidth = self.bgImage.width()
         self.bgHeight = self.bgImage.height()
 
-        self.image = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
-        self.image.fill(QColor(0, 0, 0, 0))
-        self.setPixmap(QPixmap.fromImage(self.image))
+        self.bgPixmap = QPixmap.fromImage(self.bgImage)
         self.setFixedSize(self.bgWidth, self.bgHeight)
 
+        # Stroke segments only mark their bounding box dirty; repaints of the
+        # accumulated area are coalesced to the display refresh rate.
+        self.dirtyRect = QRect()
+        self.repaintTimer = QTimer(self)
+        self.repaintTimer.setSingleShot(True)
+        self.repaintTimer.setInterval(int(1000 / max(1.0, QApplication.primaryScreen().refreshRate())))
+        self.repaintTimer.timeout.connect(self.flushRepaint)
 
         self.maskImage = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
         self.maskImage.fill(QColor(0, 0, 0, 0))
 
-        self.penActiveColor = QColor('#00FF00')
-        self.penInactiveColor = QColor('#FF0000')
-        self.penEraseColor = QColor(0, 0, 0, 0)
-        self.penColor = self.penActiveColor
+        # Trained network and scribbles of the last training run, per image
+        self.model = {}
+        self.backend = 'mlp'
+        self.superpixels = 0
+        self.segmentInfo = {}
 
-        tmp = 0
-        self.errorTest = 10 / tmp
+        # Class the pen scribbles, and the object class it returns to from
+        # the background.
+        self.penClass = 1
+        self.objectClass = 1
+        self.penEraseColor = QColor(0, 0, 0, 0)
+        self.penColor = PALETTE[self.penClass]
 
         self.pen = QPen(self.penColor, 10, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
         self.setPenWidth(10)
@@ -46,18 +71,32 @@ class Scribble(QLabel):
         self.render()
 
     def render(self):
-        qpainter = QPainter(self.image)
-        qpainter.drawImage(0, 0, self.bgImage)
-        qpainter.drawImage(0, 0, self.maskImage)
-        self.setPixmap(QPixmap.fromImage(self.image))
+        self.dirtyRect = QRect()
+        self.update()
+
+    def paintEvent(self, ev):
+        qpainter = QPainter(self)
+        qpainter.drawPixmap(ev.rect(), self.bgPixmap, ev.rect())
+        qpainter.drawImage(ev.rect(), self.maskImage, ev.rect())
+        qpainter.end()
+
+    def flushRepaint(self):
+        self.update(self.dirtyRect)
+        self.dirtyRect = QRect()
 
     def mouseMoveEvent(self, ev: QMouseEvent) -> None:
+        line = QLine(self.lastCursorPos.toPoint(), ev.position().toPoint())
         painter = QPainter(self.maskImage) 
         painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
         painter.setPen(self.pen)
-        painter.drawLine(QLine(self.lastCursorPos.toPoint(), ev.position().toPoint()))
+        painter.drawLine(line)
+        painter.end()
 
-        self.render()
+        margin = self.pen.width() // 2 + 2
+        segmentRect = QRect(line.p1(), line.p2()).normalized().adjusted(-margin, -margin, margin, margin)
+        self.dirtyRect = self.dirtyRect.united(segmentRect)
+        if not self.repaintTimer.isActive():
+            self.repaintTimer.start()
         self.lastCursorPos = ev.position()
             
         return super().mouseMoveEvent(ev)
@@ -65,15 +104,19 @@ class Scribble(QLabel):
     def mousePressEvent(self, ev): 
         self.lastCursorPos = ev.position()
     
-    def switchColor(self) -> QColor:
-        tmp = self.penActiveColor
-        self.penActiveColor = self.penInactiveColor
-        self.penInactiveColor = tmp
-        self.penColor = self.penActiveColor
+    def setPenClass(self, classIndex: int) -> QColor:
+        self.penClass = classIndex
+        if classIndex > 0:
+            self.objectClass = classIndex
+        self.penColor = PALETTE[classIndex]
         self.pen.setColor(self.penColor)
 
         return self.penColor
 
+    def switchColor(self) -> QColor:
+        # Toggles between the background and the last object class.
+        return self.setPenClass(self.objectClass if self.penClass == 0 else 0)
+
     def setPenWidth(self, newWidth: int):
         pix = QPixmap(newWidth, newWidth)
         pix.fill(QColor(0, 0, 0, 0))
@@ -85,57 +128,172 @@ class Scribble(QLabel):
 
     def toggleErase(self) -> QColor:
         if self.penColor == self.penEraseColor:
-            self.penColor = self.penActiveColor
-            self.pen.setColor(self.penColor)
-            return self.penColor
+            return self.setPenClass(self.penClass)
         
         self.penColor = self.penEraseColor
         self.pen.setColor(self.penColor)
 
         return QColor('#000000')
 
-    def applyMask(self):
-        bgImg = convertQ2N(self.bgImage)
-        convertedMask = convertQ2N(self.maskImage)
-
-        fgMask = convertedMask[:,:,1] == 255
-        bgMask = convertedMask[:,:,0] == 255
-
-        if np.sum(fgMask) == 0:
-            raise RuntimeError('Please specify some Region for segmentation (green scribble).')
-
-        fgData = getPixelData(fgMask, bgImg)
-        bgData = getPixelData(bgMask, bgImg)
-
-        data = np.concatenate((fgData, bgData), axis=0)
-        labels = np.zeros(data.shape[0])
-        labels[0:fgData.shape[0]] = 1
-
-        fullMask = np.ones([bgImg.shape[0], bgImg.shape[1]], dtype=int)
-        fullImageData = getPixelData(fullMask, bgImg)
-
-        boundary = train(data, labels, fullImageData)
-        newImage = np.reshape(boundary, (-1, bgImg.shape[1]))
+    def applyMask(self, threshold: float = 0.6):
+        probabilities = self.cachedSegment()
+        if probabilities is None:
+            probabilities = self.segment()
+        self.setMask(probabilities, threshold)
+
+    def segmentKey(self) -> str:
+        return cacheKey('segment', q2a.raw_view(self.bgImage), q2a.raw_view(self.maskImage),
+                        self.backend, self.superpixels, SCRIBBLE_PALETTE)
+
+    def cachedSegment(self) -> np.ndarray:
+        # Probabilities of an earlier run on the same image and scribbles.
+        probabilities = resultCache.get(self.segmentKey())
+        if probabilities is not None:
+            self.segmentInfo = {'backend': self.backend, 'cached': True, 'fitTime': 0.0, 'predictTime': 0.0}
+        return probabilities
+
+    def segment(self, callback=None) -> np.ndarray:
+        key = self.segmentKey()
+        self.segmentInfo = {}
+        with span('segment', backend=self.backend, superpixels=self.superpixels):
+            probabilities = segmentImage(self.bgImage, self.maskImage, callback, self.segmentInfo, self.model,
+                                         self.backend, self.superpixels)
+        resultCache.put(key, probabilities)
+        return probabilities
+
+    def setMask(self, newImage: np.ndarray, threshold: float = 0.6):
+        with span('segment.writeMask', probabilities=newImage):
+            segmented = writeMask(self.maskImage, newImage, threshold)
+        # Strokes drawn on top of this result are what the next run fine-tunes on.
+        self.model['scribbles'] = segmented
+        self.render()
 
-        self.maskImage.fill(QColor(0, 0, 0, 0))
-        for x in range(self.bgWidth):
-            for y in range(self.bgHeight):
-                if newImage[y][x] >= 0.6:
-                    self.maskImage.setPixelColor(x, y, QColor('#00FF00'))
+    def classMask(self, classIndex: int = 1) -> QImage:
+        return classMask(self.maskImage, classIndex)
 
-        self.render()
+    def copy(self, classIndex: int = 1):
+        # Every object class is in the mask after one segmentation, so any of
+        # them is cut out without running it again.
+        with span('copy.mask', mask=self.maskImage, classIndex=classIndex):
+            segmented = classPixels(self.maskImage, classIndex)
 
-    def copy(self):
-        img = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
-        img.fill(QColor(0, 0, 0, 0))
-        maskCount = 0
-        for x in range(self.bgWidth):
-            for y in range(self.bgHeight):
-                if self.maskImage.pixelColor(x, y) == QColor('#00FF00'):
-                    img.setPixelColor(x, y, self.bgImage.pixelColor(x, y))
-                    maskCount += 1
-
-        if maskCount == 0 or maskCount == (self.bgWidth * self.bgHeight):
+        maskCount = np.count_nonzero(segmented)
+        if maskCount == 0 or maskCount == segmented.size:
             raise RuntimeError('No mask found.')
 
-        return img
\ No newline at end of file
+        with span('copy.cutout', pixels=int(maskCount)):
+            img = QImage(self.bgWidth, self.bgHeight, QImage.Format.Format_ARGB32)
+            img.fill(QColor(0, 0, 0, 0))
+            q2a.recarray_view(img)[segmented] = q2a.recarray_view(self.bgImage)[segmented]
+
+        return img
+
+
+def segmentImage(bgImage: QImage, maskImage: QImage, callback=None, info: dict = None,
+                 model: dict = None, backend: str = 'mlp', superpixels: int = 0) -> np.ndarray:
+    with span('segment.convert', image=bgImage):
+        bgImg = convertQ2N(bgImage)
+        convertedMask = convertQ2N(maskImage)
+
+    # Class index per pixel, background 0, -1 where nothing is scribbled
+    scribbles = scribbleLabels(convertedMask)
+
+    if not np.any(scribbles > 0):
+        raise RuntimeError('Please specify some Region for segmentation (green scribble).')
+
+    # All object classes are segmented at once, one network output each.
+    classes = int(scribbles.max()) + 1
+    segmenter = createBackend(backend, model)
+    cacheModel = backend == 'mlp' and model is not None
+    warmStart = cacheModel and 'net' in model and model.get('classes') == classes
+    newScribbles = scribbles
+    if warmStart:
+        newScribbles = np.where(scribbles != model['scribbles'], scribbles, -1)
+    scribbled = newScribbles >= 0
+
+    features = bgImg
+    with span('segment.features', superpixels=superpixels) as featureSpan:
+        if superpixels:
+            # One sample per superpixel, labelled by the scribble class covering
+            # most of its pixels; predictions are broadcast back to the pixels.
+            spLabels, features = superpixelData(bgImg, superpixels, model)
+            count = features.shape[0]
+            counts = np.bincount(newScribbles[scribbled].astype(int) * count + spLabels[scribbled],
+                                 minlength=classes * count).reshape(classes, count)
+            top = counts.max(axis=0)
+            majority = (top > 0) & (np.count_nonzero(counts == top, axis=0) == 1)
+            data = features[majority]
+            labels = counts.argmax(axis=0)[majority]
+        else:
+            # All classes in one float32 matrix, in pixel order.
+            data = getPixelData(scribbled, bgImg)
+            labels = newScribbles[scribbled].astype(np.int64)
+        featureSpan.set(data=data)
+
+    allData, allLabels = data, labels
+    validation = None
+
+    # Without new strokes there is nothing to fine-tune on, and the cached
+    # network is reused as it is.
+    if warmStart and data.shape[0]:
+        oldData, oldLabels = model['data'], model['labels']
+        replay = replaySample(oldLabels, max(data.shape[0], REPLAY_SIZE))
+        allData = np.concatenate((oldData, data), axis=0)
+        allLabels = np.concatenate((oldLabels, labels))
+        data = np.concatenate((data, oldData[replay]), axis=0)
+        labels = np.concatenate((labels, oldLabels[replay]))
+    if warmStart:
+        validation = (allData, allLabels)
+
+    with span('segment.model', backend=backend, data=data):
+        probabilities = segmenter.segment(data, labels, features, callback, info, classes, validation)
+    if superpixels:
+        probabilities = probabilities[spLabels]
+    if info is not None:
+        info['superpixels'] = features.shape[0] if superpixels else 0
+    if cacheModel:
+        model['data'], model['labels'] = allData, allLabels
+        model['scribbles'], model['classes'] = scribbles, classes
+    return probabilities
+
+def replaySample(labels: np.ndarray, size: int) -> np.ndarray:
+    # Indices of up to size old samples, an equal share from every class, so
+    # the replay keeps the balance of the scribbles however few there are.
+    present = np.unique(labels)
+    share = max(1, size // present.shape[0])
+    return np.concatenate([np.random.choice(indices, min(indices.shape[0], share), replace=False)
+                           for indices in (np.flatnonzero(labels == label) for label in present)])
+
+def superpixelData(bgImg: np.ndarray, superpixels: int, model: dict = None):
+    # The over-segmentation only depends on the image, so it is computed
+    # once per image and kept next to the trained model.
+    if model is not None and model.get('superpixelCount') == superpixels:
+        return model['superpixelLabels'], model['superpixelFeatures']
+
+    spLabels = slic(bgImg, superpixels)
+    features = superpixelFeatures(spLabels, bgImg)
+    if model is not None:
+        model.update(superpixelCount=superpixels, superpixelLabels=spLabels, superpixelFeatures=features)
+    return spLabels, features
+
+def classPixels(maskImage: QImage, classIndex: int) -> np.ndarray:
+    # Pixels of the mask in the class color: its segmentation and strokes.
+    return q2a.raw_view(maskImage) == PALETTE[classIndex].rgba()
+
+def classMask(maskImage: QImage, classIndex: int = 1) -> QImage:
+    # One object class as a single-object mask (opaque green), the form
+    # placeInsert and the merge edits expect.
+    mask = QImage(maskImage.width(), maskImage.height(), QImage.Format.Format_ARGB32)
+    mask.fill(QColor(0, 0, 0, 0))
+    q2a.raw_view(mask)[classPixels(maskImage, classIndex)] = 0xFF00FF00
+    return mask
+
+def writeMask(maskImage: QImage, newImage: np.ndarray, threshold: float = 0.6) -> np.ndarray:
+    # Paints each object class in its palette color and returns the class
+    # map of segmentLabels.
+    maskImage.fill(QColor(0, 0, 0, 0))
+    maskView = q2a.raw_view(maskImage)
+    segmented = segmentLabels(newImage, threshold)
+    for classIndex in range(1, newImage.shape[-1]):
+        maskView[segmented == classIndex] = PALETTE[classIndex].rgba()
+    return segmented
@@ -0,0 +1,226 @@
+import time
+
+import numpy as np
+from numpy import ndarray
+
+from src.lazy import lazyImport
+from src.tiles import featureChunks, probabilityMap
+
+linalg = lazyImport('scipy.linalg')
+network = lazyImport('src.network')
+spatial = lazyImport('scipy.spatial')
+special = lazyImport('scipy.special')
+
+# Hyperparameters
+GMM_COMPONENTS = 5
+GMM_ITERATIONS = 100
+GMM_TOL = 1e-4
+KNN_NEIGHBOURS = 10
+MAX_SAMPLES = 20000
+
+
+def subsample(data: ndarray, size: int, rng) -> ndarray:
+    if data.shape[0] <= size:
+        return data
+    return data[rng.choice(data.shape[0], size, replace=False)]
+
+def classData(data: ndarray, labels: ndarray, classes: int) -> list:
+    # Samples of each class, background first; object classes may be empty.
+    perClass = [data[labels == label] for label in range(classes)]
+    if perClass[0].shape[0] == 0:
+        raise RuntimeError('Please specify some background for segmentation (red scribble).')
+    return perClass
+
+
+class SegmentationBackend:
+    # Backends predict one probability per class, background first, in the
+    # last axis of their output.
+    name = None
+
+    def __init__(self, model: dict = None):
+        self.model = model
+        self.classes = 2
+
+    def fit(self, data: ndarray, labels: ndarray, callback=None):
+        raise NotImplementedError
+
+    def predictFeatures(self, features: ndarray) -> ndarray:
+        raise NotImplementedError
+
+    def predict(self, img: ndarray, chunkSize: int = None, callback=None) -> ndarray:
+        # img is an (H, W, 3) image, a TiledImage or an (N, 5) feature
+        # matrix, e.g. one row per superpixel. callback gets the chunk and
+        # the fraction of pixels done before each chunk, so a cancel stops
+        # the prediction between chunks.
+        if chunkSize is None:
+            chunkSize = network.CHUNK_SIZE
+        if img.ndim == 2:
+            if callback is not None:
+                callback(0, 0.0)
+            return self.predictFeatures(img.astype(np.float32, copy=False)).astype(np.float32)
+
+        probabilities = probabilityMap(img, self.classes)
+        total = img.shape[0] * img.shape[1]
+        done = 0
+        for chunk, (index, features) in enumerate(featureChunks(img, chunkSize)):
+            if callback is not None:
+                callback(chunk, done / total)
+            probabilities[index] = self.predictFeatures(features).reshape(probabilities[index].shape)
+            done += features.shape[0]
+        return probabilities
+
+    def segment(self, data: ndarray, labels: ndarray, img: ndarray, callback=None, info: dict = None,
+                classes: int = None, validation: tuple = None) -> ndarray:
+        # labels are class indices; classes defaults to the highest one present.
+        # validation, every scribble so far, only matters to warm starts.
+        self.classes = classes or max(2, int(labels.max()) + 1)
+        start = time.perf_counter()
+        self.fit(data, labels, callback)
+        fitTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        probabilities = self.predict(img, callback=callback)
+        if info is not None:
+            info.update(backend=self.name, samples=int(data.shape[0]), classes=self.classes, fitTime=fitTime,
+                        predictTime=time.perf_counter() - start)
+        return probabilities
+
+
+class MLPBackend(SegmentationBackend):
+    name = 'mlp'
+
+    def segment(self, data: ndarray, labels: ndarray, img: ndarray, callback=None, info: dict = None,
+                classes: int = None, validation: tuple = None) -> ndarray:
+        # network.train fits and predicts in one go and handles warm starts
+        # from the model cache itself.
+        trainInfo = {}
+        probabilities = network.train(data, labels, img, callback, info=trainInfo, model=self.model,
+                                      classes=classes, validation=validation)
+        if info is not None:
+            info.update(trainInfo, backend=self.name, fitTime=trainInfo['trainTime'],
+                        predictTime=trainInfo['inferenceTime'])
+        return probabilities
+
+
+class GaussianMixture:
+    def __init__(self, components: int, rng):
+        self.components = components
+        self.rng = rng
+
+    def fit(self, x: ndarray, callback=None):
+        n = x.shape[0]
+        k = min(self.components, n)
+
+        # k-means++ seeding, then EM from the hard assignment.
+        centers = [x[self.rng.integers(n)]]
+        for _ in range(1, k):
+            dist = np.min([np.sum((x - c)**2, axis=1) for c in centers], axis=0)
+            if not dist.sum():
+                break
+            centers.append(x[self.rng.choice(n, p=dist / dist.sum())])
+        centers = np.array(centers)
+        assign = np.argmin(((x[:,None,:] - centers[None])**2).sum(axis=2), axis=1)
+        resp = np.eye(centers.shape[0])[assign]
+
+        lastLikelihood = -np.inf
+        for iteration in range(GMM_ITERATIONS):
+            self.mStep(x, resp)
+            logProb = self.componentLogProb(x)
+            likelihood = special.logsumexp(logProb, axis=1)
+            resp = np.exp(logProb - likelihood[:,None])
+
+            meanLikelihood = likelihood.mean()
+            if callback is not None:
+                callback(iteration, -meanLikelihood)
+            if meanLikelihood - lastLikelihood < GMM_TOL:
+                break
+            lastLikelihood = meanLikelihood
+
+    def mStep(self, x: ndarray, resp: ndarray):
+        d = x.shape[1]
+        counts = resp.sum(axis=0) + 1e-10
+        self.weights = counts / counts.sum()
+        self.means = (resp.T @ x) / counts[:,None]
+        self.choleskys = []
+        for j in range(self.means.shape[0]):
+            diff = x - self.means[j]
+            cov = (resp[:,j,None] * diff).T @ diff / counts[j] + 1e-6 * np.eye(d)
+            self.choleskys.append(linalg.cho_factor(cov, lower=True)[0])
+
+    def componentLogProb(self, x: ndarray) -> ndarray:
+        d = x.shape[1]
+        logProb = np.empty((x.shape[0], self.means.shape[0]))
+        for j, chol in enumerate(self.choleskys):
+            z = linalg.solve_triangular(chol, (x - self.means[j]).T, lower=True)
+            logDet = 2 * np.sum(np.log(np.diag(chol)))
+            logProb[:,j] = (np.log(self.weights[j]) - 0.5 * (d * np.log(2 * np.pi) + logDet)
+                            - 0.5 * np.sum(z**2, axis=0))
+        return logProb
+
+    def logLikelihood(self, x: ndarray) -> ndarray:
+        return special.logsumexp(self.componentLogProb(x), axis=1)
+
+
+class GMMBackend(SegmentationBackend):
+    name = 'gmm'
+
+    def fit(self, data: ndarray, labels: ndarray, callback=None):
+        rng = np.random.default_rng(0)
+        perClass = classData(data, labels, self.classes)
+        self.mean = data.mean(axis=0)
+        self.std = data.std(axis=0) + 1e-6
+
+        # One mixture per class; classes without samples get none.
+        self.mixtures = []
+        for classSamples in perClass:
+            mixture = None
+            if classSamples.shape[0]:
+                mixture = GaussianMixture(GMM_COMPONENTS, rng)
+                mixture.fit((subsample(classSamples, MAX_SAMPLES, rng) - self.mean) / self.std, callback)
+            self.mixtures.append(mixture)
+
+    def predictFeatures(self, features: ndarray) -> ndarray:
+        x = (features - self.mean) / self.std
+        logLikelihood = np.full((x.shape[0], len(self.mixtures)), -np.inf)
+        for label, mixture in enumerate(self.mixtures):
+            if mixture is not None:
+                logLikelihood[:,label] = mixture.logLikelihood(x)
+        # Equal class priors, as the scribbles say nothing about area.
+        return special.softmax(logLikelihood, axis=1)
+
+
+class KNNBackend(SegmentationBackend):
+    name = 'knn'
+
+    def fit(self, data: ndarray, labels: ndarray, callback=None):
+        rng = np.random.default_rng(0)
+        perClass = classData(data, labels, self.classes)
+        self.mean = data.mean(axis=0)
+        self.std = data.std(axis=0) + 1e-6
+
+        perClass = [subsample(classSamples, MAX_SAMPLES // self.classes, rng) for classSamples in perClass]
+        self.tree = spatial.cKDTree((np.concatenate(perClass) - self.mean) / self.std)
+        # Neighbour votes are weighted by inverse class frequency.
+        self.voteLabels = np.concatenate([np.full(classSamples.shape[0], label)
+                                          for label, classSamples in enumerate(perClass)])
+        self.voteWeights = np.concatenate([np.full(classSamples.shape[0], 1 / max(1, classSamples.shape[0]))
+                                           for classSamples in perClass])
+
+    def predictFeatures(self, features: ndarray) -> ndarray:
+        k = min(KNN_NEIGHBOURS, self.voteLabels.shape[0])
+        _, idx = self.tree.query((features - self.mean) / self.std, k=k, workers=-1)
+        idx = idx.reshape(-1, k)
+        voteLabels = self.voteLabels[idx]
+        voteWeights = self.voteWeights[idx]
+        votes = np.empty((idx.shape[0], self.classes))
+        for label in range(self.classes):
+            votes[:,label] = np.sum(np.where(voteLabels == label, voteWeights, 0), axis=1)
+        return votes / votes.sum(axis=1, keepdims=True)
+
+
+BACKENDS = {backend.name: backend for backend in (MLPBackend, GMMBackend, KNNBackend)}
+
+def createBackend(name: str, model: dict = None) -> SegmentationBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown segmentation backend '{name}'.")
+    return BACKENDS[name](model)
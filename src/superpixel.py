@@ -0,0 +1,72 @@
+import numpy as np
+from numpy import ndarray
+
+from src.utils import featureScale
+
+SUPERPIXELS = 2000
+COMPACTNESS = 20.0
+ITERATIONS = 5
+
+
+def slic(img: ndarray, segments: int = SUPERPIXELS, compactness: float = COMPACTNESS,
+         iterations: int = ITERATIONS) -> ndarray:
+    # SLIC on (row, col, r, g, b): centers start on a regular grid and every
+    # pixel only competes for the centers of its own and the eight adjacent
+    # grid cells, which keeps each iteration a handful of array operations.
+    height, width = img.shape[:2]
+    step = max(1, int(np.sqrt(height * width / segments)))
+    gridY = -(-height // step)
+    gridX = -(-width // step)
+
+    color = img.astype(np.float32)
+    rows = np.arange(height, dtype=np.float32)
+    cols = np.arange(width, dtype=np.float32)
+    cellY = np.arange(height) // step
+    cellX = np.arange(width) // step
+
+    centerY = np.minimum((np.arange(gridY) + 0.5) * step, height - 1).astype(int)
+    centerX = np.minimum((np.arange(gridX) + 0.5) * step, width - 1).astype(int)
+    centers = np.zeros((gridY * gridX, 5), dtype=np.float32)
+    centers[:,0] = np.repeat(centerY, gridX)
+    centers[:,1] = np.tile(centerX, gridY)
+    centers[:,2:] = color[centers[:,0].astype(int), centers[:,1].astype(int)]
+
+    spatialWeight = (compactness / step)**2
+    labels = np.zeros((height, width), dtype=np.int64)
+    for _ in range(iterations):
+        best = np.full((height, width), np.inf, dtype=np.float32)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                idx = (np.clip(cellY + dy, 0, gridY - 1)[:,None] * gridX +
+                       np.clip(cellX + dx, 0, gridX - 1)[None,:])
+                center = centers[idx]
+                dist = np.sum((color - center[...,2:])**2, axis=2)
+                dist += spatialWeight * ((rows[:,None] - center[...,0])**2 + (cols[None,:] - center[...,1])**2)
+                better = dist < best
+                best[better] = dist[better]
+                labels[better] = idx[better]
+
+        features = superpixelFeatures(labels, img, gridY * gridX) / featureScale(height, width)
+        counts = np.bincount(labels.ravel(), minlength=gridY * gridX)
+        centers[counts > 0] = features[counts > 0]
+
+    # Consecutive labels for the superpixels that kept any pixels
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels.reshape(height, width)
+
+def superpixelFeatures(labels: ndarray, img: ndarray, count: int = None) -> ndarray:
+    # Centroid and mean color per superpixel, normalized like getPixelData's
+    # (x, y, r, g, b) features.
+    if count is None:
+        count = int(labels.max()) + 1
+    flat = labels.ravel()
+    counts = np.maximum(np.bincount(flat, minlength=count), 1)
+    rows, cols = np.indices(labels.shape)
+
+    features = np.empty((count, 5), dtype=np.float32)
+    features[:,0] = np.bincount(flat, weights=rows.ravel(), minlength=count) / counts
+    features[:,1] = np.bincount(flat, weights=cols.ravel(), minlength=count) / counts
+    for i in range(3):
+        features[:,i+2] = np.bincount(flat, weights=img[:,:,i].ravel(), minlength=count) / counts
+    features *= featureScale(*labels.shape)
+    return features
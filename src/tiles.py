@@ -0,0 +1,272 @@
+import math
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+from numpy import ndarray
+from PySide6.QtCore import QRect, QSize, Qt
+from PySide6.QtGui import QImage, QImageIOHandler, QImageReader, QTransform
+import qimage2ndarray as q2a
+
+from src.lazy import lazyImport
+from src.utils import (SCRIBBLE_PALETTE, convertQ2N, getPixelData, pixelFeatureChunks, placeInsert, poisson_edit,
+                       scribbleLabels, segmentLabels, trimImage)
+
+TILE_SIZE = 1024
+# poisson_edit solves on the mask's bounding box plus this many pixels
+# (dilated mask and Dirichlet border), so that is all the overlap a
+# region needs to blend exactly like a full-canvas solve.
+POISSON_OVERLAP = 2
+# Backing files of tiled images, the system temp directory by default.
+TILE_DIR = os.environ.get('POISSON_TILE_DIR') or None
+
+# Level of the band-wise PNG writer; 6 is zlib's (and Qt's) default.
+PNG_COMPRESSION = 6
+
+segmentation = lazyImport('src.segmentation')
+
+# QImageReader's allocation limit is process-wide.
+allocationLock = threading.Lock()
+
+
+def tiledArray(shape, dtype) -> ndarray:
+    # Memory-mapped array on an anonymous temporary file; the pages live in
+    # the page cache and the file disappears with the mapping.
+    with tempfile.TemporaryFile(dir=TILE_DIR) as file:
+        return np.memmap(file, dtype=dtype, mode='w+', shape=shape)
+
+def supportsClipRect(reader: QImageReader) -> bool:
+    # JPEG decodes just a clip rect; PNG, among others, always decodes everything.
+    return reader.supportsOption(QImageIOHandler.ImageOption.ClipRect)
+
+def readImage(reader: QImageReader) -> QImage:
+    # Formats that cannot decode part of an image decode all of it, which Qt
+    # refuses above QImageReader.allocationLimit() (128 MB by default); the
+    # limit is raised to what this image needs for the one read.
+    size = reader.size()
+    needed = math.ceil(max(0, size.width()) * max(0, size.height()) * 4 / 2**20) + 1
+    with allocationLock:
+        limit = QImageReader.allocationLimit()
+        if limit:
+            QImageReader.setAllocationLimit(max(limit, needed))
+        try:
+            return reader.read()
+        finally:
+            QImageReader.setAllocationLimit(limit)
+
+def loadPreview(path: str, maxSize: QSize) -> QImage:
+    # Decodes at most maxSize (keeping the aspect ratio) instead of the full
+    # image where the format can; PNG is decoded whole and then scaled.
+    reader = QImageReader(path)
+    size = reader.size()
+    if size.width() > maxSize.width() or size.height() > maxSize.height():
+        reader.setScaledSize(size.scaled(maxSize, Qt.AspectRatioMode.KeepAspectRatio))
+    img = readImage(reader)
+    if img.isNull():
+        raise FileNotFoundError(f"Error reading image '{path}': {reader.errorString()}")
+    return img.convertToFormat(QImage.Format.Format_ARGB32)
+
+def loadRegion(path: str, rect: QRect) -> QImage:
+    # Decodes only rect where the format supports clip rects, otherwise the
+    # whole image once.
+    reader = QImageReader(path)
+    if supportsClipRect(reader):
+        reader.setClipRect(rect)
+        img = reader.read()
+    else:
+        img = readImage(reader)
+        if not img.isNull():
+            img = img.copy(rect)
+    if img.isNull():
+        raise OSError(f"Error reading image '{path}': {reader.errorString()}")
+    return img.convertToFormat(QImage.Format.Format_ARGB32)
+
+def writePng(path: str, pixels: ndarray, bandHeight: int):
+    # (H, W, 3) uint8 pixels as an 8-bit RGB PNG, compressed and written one
+    # band of rows at a time. Every row uses the Sub filter (difference to
+    # the pixel on its left), which vectorizes and suits photographs.
+    height, width = pixels.shape[:2]
+
+    def chunk(file, kind: bytes, data: bytes):
+        file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        chunk(file, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        compressor = zlib.compressobj(PNG_COMPRESSION)
+        for row in range(0, height, bandHeight):
+            band = np.asarray(pixels[row:row + bandHeight]).reshape(-1, width * 3)
+            scanlines = np.empty((band.shape[0], width * 3 + 1), dtype=np.uint8)
+            scanlines[:,0] = 1
+            scanlines[:,1:4] = band[:,:3]
+            np.subtract(band[:,3:], band[:,:-3], out=scanlines[:,4:])
+            data = compressor.compress(scanlines.data)
+            if data:
+                chunk(file, b'IDAT', data)
+        chunk(file, b'IDAT', compressor.flush())
+        chunk(file, b'IEND', b'')
+
+
+class TiledImage:
+    # (H, W, 3) uint8 pixels in a memory-mapped buffer, read and written one
+    # tile at a time so only the tiles in use need to be resident.
+    def __init__(self, height: int, width: int, tileSize: int = TILE_SIZE):
+        self.pixels = tiledArray((height, width, 3), np.uint8)
+        self.tileSize = tileSize
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+    @classmethod
+    def fromFile(cls, path: str, tileSize: int = TILE_SIZE) -> 'TiledImage':
+        # Decoded in bands of tile rows through clip rects where the format
+        # supports them (JPEG), so the full image never exists as a QImage.
+        # Other formats (PNG) are decoded whole once and copied over band by
+        # band, so that decode is the one full-size allocation.
+        reader = QImageReader(path)
+        size = reader.size()
+        if not size.isValid():
+            raise FileNotFoundError(f"Error reading image '{path}'")
+        tiled = cls(size.height(), size.width(), tileSize)
+        whole = None
+        if not supportsClipRect(reader):
+            whole = readImage(reader)
+            if whole.isNull():
+                raise OSError(f"Error reading image '{path}': {reader.errorString()}")
+        for row in range(0, size.height(), tileSize):
+            rect = QRect(0, row, size.width(), min(tileSize, size.height() - row))
+            if whole is None:
+                reader = QImageReader(path)
+                reader.setClipRect(rect)
+                band = reader.read()
+                if band.isNull():
+                    raise OSError(f"Error reading image '{path}': {reader.errorString()}")
+            else:
+                band = whole.copy(rect)
+            band = band.convertToFormat(QImage.Format.Format_ARGB32)
+            tiled.pixels[row:row + band.height()] = convertQ2N(band)
+        return tiled
+
+    @classmethod
+    def fromQImage(cls, img: QImage, tileSize: int = TILE_SIZE) -> 'TiledImage':
+        tiled = cls(img.height(), img.width(), tileSize)
+        pixels = convertQ2N(img)
+        for rows, cols in tiled.tiles():
+            tiled.pixels[rows, cols] = pixels[rows, cols]
+        return tiled
+
+    def tiles(self):
+        for row in range(0, self.height(), self.tileSize):
+            for col in range(0, self.width(), self.tileSize):
+                yield np.s_[row:min(row + self.tileSize, self.height()), col:min(col + self.tileSize, self.width())]
+
+    def featureChunks(self, chunkSize: int):
+        # pixelFeatureChunks per tile, with coordinates normalized to the full image.
+        for rows, cols in self.tiles():
+            for chunkRows, features in pixelFeatureChunks(self.pixels[rows, cols], chunkSize,
+                                                          (rows.start, cols.start), self.shape[:2]):
+                yield np.s_[rows.start + chunkRows.start:rows.start + chunkRows.stop, cols], features
+
+    def toQImage(self) -> QImage:
+        img = QImage(self.width(), self.height(), QImage.Format.Format_RGB32)
+        view = q2a.rgb_view(img)
+        for rows, cols in self.tiles():
+            view[rows, cols] = self.pixels[rows, cols]
+        return img
+
+    def save(self, path: str):
+        # PNG is written band by band; other formats need the whole image as
+        # one QImage first.
+        if os.path.splitext(path)[1].lower() == '.png':
+            try:
+                writePng(path, self.pixels, self.tileSize)
+            except OSError as e:
+                raise OSError(f"Error writing image '{path}': {e}")
+        elif not self.toQImage().save(path):
+            raise OSError(f"Error writing image '{path}'")
+
+
+def featureChunks(img, chunkSize: int):
+    if isinstance(img, TiledImage):
+        return img.featureChunks(chunkSize)
+    return pixelFeatureChunks(img, chunkSize)
+
+def probabilityMap(img, classes: int) -> ndarray:
+    # Output for per-pixel class probabilities; memory-mapped for tiled images.
+    if isinstance(img, TiledImage):
+        return tiledArray(img.shape[:2] + (classes,), np.float32)
+    return np.empty(img.shape[:2] + (classes,), dtype=np.float32)
+
+def segmentTiled(source: TiledImage, scribble: TiledImage, callback=None, info: dict = None,
+                 backend: str = 'mlp') -> ndarray:
+    # segmentImage for tiled images: the scribbled pixels are gathered tile
+    # by tile and inference writes into a memory-mapped probability map.
+    counts = np.zeros(len(SCRIBBLE_PALETTE), dtype=int)
+    for rows, cols in source.tiles():
+        tileLabels = scribbleLabels(scribble.pixels[rows, cols])
+        counts += np.bincount(tileLabels[tileLabels >= 0], minlength=counts.shape[0])
+    if counts[1:].sum() == 0:
+        raise RuntimeError('Please specify some Region for segmentation (green scribble).')
+
+    data = np.empty((counts.sum(), 5), dtype=np.float32)
+    labels = np.empty(counts.sum(), dtype=np.int64)
+    offset = 0
+    for rows, cols in source.tiles():
+        tileLabels = scribbleLabels(scribble.pixels[rows, cols])
+        scribbled = tileLabels >= 0
+        n = np.count_nonzero(scribbled)
+        getPixelData(scribbled, source.pixels[rows, cols], out=data[offset:offset + n],
+                     origin=(rows.start, cols.start), shape=source.shape[:2])
+        labels[offset:offset + n] = tileLabels[scribbled]
+        offset += n
+
+    classes = max(2, int(np.flatnonzero(counts).max()) + 1)
+    return segmentation.createBackend(backend).segment(data, labels, source, callback, info, classes)
+
+def writeMaskTiled(probabilities: ndarray, threshold: float, classIndex: int = 1,
+                   tileSize: int = TILE_SIZE) -> ndarray:
+    # Mask of one object class, see segmentLabels.
+    mask = tiledArray(probabilities.shape[:2], np.bool_)
+    for row in range(0, probabilities.shape[0], tileSize):
+        mask[row:row + tileSize] = segmentLabels(probabilities[row:row + tileSize], threshold) == classIndex
+    return mask
+
+def compositeTiled(result: TiledImage, img: QImage, mask: QImage, transform: QTransform,
+                   x: float, y: float, scaleX: float, solver: str = 'direct', callback=None,
+                   info: dict = None):
+    # Blends the insert into result in place, like poisson_edit on the
+    # canvases from placeInsert, but only reads and writes the region under
+    # the insert plus the overlap the solve needs.
+    trimmedMask = trimImage(mask, mask).transformed(transform)
+    placedSize = trimmedMask.scaledToWidth(scaleX + trimmedMask.width()).size()
+
+    margin = POISSON_OVERLAP + 1
+    left = math.floor(x) - margin
+    top = math.floor(y) - margin
+    roi = QRect(left, top, placedSize.width() + 2 * margin + 1,
+                placedSize.height() + 2 * margin + 1).intersected(QRect(0, 0, result.width(), result.height()))
+    if roi.isEmpty():
+        if info is not None:
+            info.update(solver=solver, roi=None, unknowns=0, iterations=0, residual=0.0)
+        return
+
+    targetImg, maskImg = placeInsert(img, mask, roi.width(), roi.height(), transform,
+                                     x - roi.x(), y - roi.y(), scaleX)
+    region = np.s_[roi.y():roi.y() + roi.height(), roi.x():roi.x() + roi.width()]
+    blended = poisson_edit(np.array(result.pixels[region]), convertQ2N(targetImg),
+                           convertQ2N(maskImg)[:,:,1] == 255, solver, info, callback)
+    result.pixels[region] = np.clip(blended, 0, 255)
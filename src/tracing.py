@@ -0,0 +1,108 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+# Set POISSON_TRACE to a file name to record spans; the trace is written
+# there as Chrome trace-event JSON (chrome://tracing, Perfetto) on exit.
+TRACE_PATH = os.environ.get('POISSON_TRACE')
+ENABLED = bool(TRACE_PATH)
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 0
+
+_events = []
+_lock = threading.Lock()
+_start = time.perf_counter()
+
+
+def residentMemory() -> int:
+    # Resident set size in bytes, 0 where /proc is not available.
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return 0
+
+def describe(value):
+    if hasattr(value, 'shape') and hasattr(value, 'nbytes'):
+        return {'shape': list(value.shape), 'dtype': str(value.dtype), 'bytes': int(value.nbytes)}
+    if hasattr(value, 'sizeInBytes'):
+        return {'size': [value.width(), value.height()], 'bytes': int(value.sizeInBytes())}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class Span:
+    __slots__ = ('name', 'args', 'start', 'memory')
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.memory = residentMemory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        args = {key: describe(value) for key, value in self.args.items()}
+        args['memoryDelta'] = residentMemory() - self.memory
+        event = {
+            'name': self.name,
+            'ph': 'X',
+            'ts': (self.start - _start) * 1e6,
+            'dur': (end - self.start) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        }
+        with _lock:
+            _events.append(event)
+        return False
+
+
+class NullSpan:
+    # Shared stand-in while tracing is off, so a span costs one function call.
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+def span(name: str, **args):
+    # Arrays and QImages passed as args are recorded by shape and size.
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name, args)
+
+def events() -> list:
+    with _lock:
+        return list(_events)
+
+def clear():
+    with _lock:
+        _events.clear()
+
+def export(path: str):
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events(), 'displayTimeUnit': 'ms'}, file)
+
+if ENABLED:
+    atexit.register(export, TRACE_PATH)
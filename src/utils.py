@@ -1,23 +1,87 @@
+import hashlib
+import threading
+import time
+
 import numpy as np
 from numpy import ndarray
-from PySide6.QtGui import QImage, QColor
+from PySide6.QtGui import QImage, QColor, QPainter, QTransform
 import qimage2ndarray as q2a
-from scipy import sparse
-from scipy.ndimage import binary_dilation
-import matplotlib.pyplot as plt
 
-def getPixelData(mask: ndarray, img: ndarray) -> ndarray:
-    x, y = np.where(mask)
-    pixelData = np.zeros((np.sum(mask), 5))
-    pixelData[:,0] = x
-    pixelData[:,1] = y
+from src.lazy import lazyImport
+from src.tracing import span
+
+fft = lazyImport('scipy.fft')
+ndimage = lazyImport('scipy.ndimage')
+sparse = lazyImport('scipy.sparse')
+
+COLOR_SCALE = 1 / 255
+# Pixels kept around the mask by trimImage, at whatever resolution it runs.
+TRIM_PADDING = 3
+# Scribble colors of the segmentation classes: background, then the objects.
+SCRIBBLE_PALETTE = ((255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255), (0, 255, 255))
+
+def featureScale(height: int, width: int) -> ndarray:
+    # Per-column factors that map (x, y, r, g, b) features to [0, 1].
+    return np.array([1 / max(1, height - 1), 1 / max(1, width - 1),
+                     COLOR_SCALE, COLOR_SCALE, COLOR_SCALE], dtype=np.float32)
+
+def getPixelData(mask: ndarray, img: ndarray, out: ndarray = None, dtype=np.float32,
+                 origin=(0, 0), shape=None) -> ndarray:
+    # Normalized (x, y, r, g, b) features of the masked pixels. With out, the
+    # features are written into that (N, 5) buffer, e.g. a slice of the
+    # training matrix that torch.from_numpy shares without copying. For a
+    # tile of a larger image, origin and shape give the tile's position and
+    # the full image size the coordinates are normalized to.
+    idx = np.flatnonzero(mask)
+    if out is None:
+        out = np.empty((idx.shape[0], 5), dtype=dtype)
+    elif out.shape != (idx.shape[0], 5):
+        raise ValueError(f"Feature buffer has shape {out.shape}, expected {(idx.shape[0], 5)}.")
 
-    for i in range(3):
-        pixelData[:,i+2] = img[x, y, i]
+    scale = featureScale(*(shape or mask.shape))
+    x, y = np.divmod(idx, mask.shape[1])
+    np.multiply(img[x, y], scale[2:], out=out[:,2:], casting='unsafe')
+    np.multiply(x + origin[0], scale[0], out=out[:,0], casting='unsafe')
+    np.multiply(y + origin[1], scale[1], out=out[:,1], casting='unsafe')
+    return out
 
-    return pixelData
+def scribbleLabels(scribbles: ndarray) -> ndarray:
+    # Class index per pixel of an (H, W, 3) scribble image, -1 where its
+    # color is not in SCRIBBLE_PALETTE (nothing scribbled).
+    packed = ((scribbles[...,0].astype(np.uint32) << 16) | (scribbles[...,1].astype(np.uint32) << 8)
+              | scribbles[...,2])
+    labels = np.full(packed.shape, -1, dtype=np.int8)
+    for label, (red, green, blue) in enumerate(SCRIBBLE_PALETTE):
+        labels[packed == (red << 16 | green << 8 | blue)] = label
+    return labels
+
+def segmentLabels(probabilities: ndarray, threshold: float) -> ndarray:
+    # Object class per pixel of a (..., classes) probability map where the
+    # most likely class reaches threshold; -1 for background and undecided.
+    labels = np.argmax(probabilities, axis=-1).astype(np.int8)
+    labels[(labels == 0) | (np.max(probabilities, axis=-1) < threshold)] = -1
+    return labels
+
+def pixelFeatureChunks(img: ndarray, chunkSize: int, origin=(0, 0), shape=None):
+    # Same normalized features as getPixelData over the whole image, built
+    # per chunk of whole rows so the full matrix never exists at once.
+    # The yielded buffer is reused between chunks.
+    height, width = img.shape[:2]
+    scale = featureScale(*(shape or (height, width)))
+    rows = max(1, chunkSize // width)
+    features = np.empty((rows * width, 5), dtype=np.float32)
+    features[:,1] = (np.tile(np.arange(width), rows) + origin[1]) * scale[1]
+
+    for row in range(0, height, rows):
+        chunk = img[row:row + rows]
+        n = chunk.shape[0] * width
+        features[:n,0] = (np.repeat(np.arange(row, row + chunk.shape[0]), width) + origin[0]) * scale[0]
+        np.multiply(chunk.reshape(n, 3), scale[2:], out=features[:n,2:])
+        yield slice(row, row + chunk.shape[0]), features[:n]
 
 def plotQImage(img: QImage):
+    # Debugging aid only, so matplotlib stays off the import path.
+    import matplotlib.pyplot as plt
     arr = q2a.rgb_view(img)
     plt.figure()
     plt.imshow(arr)
@@ -25,45 +89,62 @@ def plotQImage(img: QImage):
 
 def trimImage(img: QImage, mask: QImage) -> QImage:
     alpha = q2a.recarray_view(mask)['alpha']
-    boundX0 = 0
-    boundX1 = alpha.shape[0]
-    boundY0 = 0
-    boundY1 = alpha.shape[1]
-
-    for x in range(alpha.shape[0]):
-        if np.sum(alpha[x,:]):
-            boundX0 = x
-            break
+    rows = np.any(alpha, axis=1)
+    cols = np.any(alpha, axis=0)
 
-    for x in reversed(range(alpha.shape[0])):
-        if np.sum(alpha[x,:]):
-            boundX1 = x
-            break
-
-    for y in range(alpha.shape[1]):
-        if np.sum(alpha[:,y]):
-            boundY0 = y
-            break
-
-    for y in reversed(range(alpha.shape[1])):
-        if np.sum(alpha[:,y]):
-            boundY1 = y
-            break
+    if rows.any():
+        boundX0 = int(np.argmax(rows))
+        boundX1 = alpha.shape[0] - 1 - int(np.argmax(rows[::-1]))
+        boundY0 = int(np.argmax(cols))
+        boundY1 = alpha.shape[1] - 1 - int(np.argmax(cols[::-1]))
+    else:
+        boundX0, boundX1 = 0, alpha.shape[0]
+        boundY0, boundY1 = 0, alpha.shape[1]
 
-    boundX0 = max(0, boundX0 - 3)
-    boundX1 = min(alpha.shape[0], boundX1 + 3)
-    boundY0 = max(0, boundY0 - 3)
-    boundY1 = min(alpha.shape[1], boundY1 + 3)
+    boundX0 = max(0, boundX0 - TRIM_PADDING)
+    boundX1 = min(alpha.shape[0], boundX1 + TRIM_PADDING)
+    boundY0 = max(0, boundY0 - TRIM_PADDING)
+    boundY1 = min(alpha.shape[1], boundY1 + TRIM_PADDING)
 
     newImg = QImage((boundY1 - boundY0), (boundX1 - boundX0), QImage.Format.Format_ARGB32)
-    newImg.fill(QColor(0, 0, 0, 0))
+    q2a.raw_view(newImg)[:] = q2a.raw_view(img)[boundX0:boundX1, boundY0:boundY1]
 
-    for x in range(newImg.size().height()):
-        for y in range(newImg.size().width()):
-            newImg.setPixelColor(y, x, img.pixelColor(y + boundY0, x + boundX0))
-    
     return newImg
 
+def placeInsert(img: QImage, mask: QImage, width: int, height: int, transform: QTransform,
+                x: float, y: float, scaleX: float):
+    with span('placeInsert.trim', image=img):
+        trimmedImg = trimImage(img, mask)
+        trimmedMask = trimImage(mask, mask)
+    with span('placeInsert.transform', image=trimmedImg):
+        trimmedImg = trimmedImg.transformed(transform)
+        trimmedMask = trimmedMask.transformed(transform)
+
+    placed = []
+    with span('placeInsert.draw', width=width, height=height):
+        for insert in (trimmedImg, trimmedMask):
+            canvas = QImage(width, height, QImage.Format.Format_ARGB32)
+            canvas.fill(QColor(0, 0, 0, 0))
+            painter = QPainter(canvas)
+            painter.drawImage(x, y, insert.scaledToWidth(scaleX + insert.size().width()))
+            painter.end()
+            placed.append(canvas)
+
+    return placed[0], placed[1]
+
+def upsampleMask(mask: ndarray, height: int, width: int, region: tuple = None) -> ndarray:
+    # Bilinear resampling with aligned pixel centers, thresholded at 0.5.
+    # region, a (rows, columns) pair of slices, resamples only that part of
+    # the height x width result.
+    scale = np.array([mask.shape[0] / height, mask.shape[1] / width])
+    if region is None:
+        region = (slice(0, height), slice(0, width))
+    origin = np.array([region[0].start, region[1].start])
+    shape = (region[0].stop - region[0].start, region[1].stop - region[1].start)
+    resampled = ndimage.affine_transform(mask.astype(np.float32), scale, offset=scale * (origin + 0.5) - 0.5,
+                                 output_shape=shape, order=1, mode='nearest')
+    return resampled >= 0.5
+
 def convertQ2N(img: QImage) -> ndarray:
     return q2a.rgb_view(img)
 
@@ -75,40 +156,336 @@ def D_matrix(n: int) -> ndarray:
     D = sparse.spdiags([e, -e], [0, 1], n-1, n)
     return D
 
-def poisson_edit(source: ndarray, target: ndarray, mask: ndarray) -> ndarray:
-    combinedImage = source.copy()
-    dilatedMask = binary_dilation(mask, np.ones((3, 3)))
-    combinedImage[dilatedMask] = target[dilatedMask]
-
-    nx, ny, nc = source.shape
-    m = mask.reshape(ny*nx, order='F')
-
-    Dx = sparse.kron(sparse.identity(ny), D_matrix(nx))
-    Dy = sparse.kron(D_matrix(ny), sparse.identity(nx))
-    Dhat = sparse.vstack([Dx, Dy])
-
-    n = nx*ny
-    nr = np.sum(m)
-
-    data = np.ones(nr)
-    j = range(nr)
-    i = np.where(m)[0]
-    I = sparse.coo_matrix((data, (i, j)), shape=(n, nr))
-
-    final = np.zeros(n*nc, dtype=int)
-    final = final.reshape((nx, ny, nc))
-    for ch in range(nc):
-        f = source[:,:,ch].reshape(nx*ny, order='F')
-        h = combinedImage[:,:,ch].reshape(nx*ny, order='F')
-        A = Dhat@I
-        b = -Dhat@((1-m)*f)
-        b_addition = Dhat@h
-        x = sparse.linalg.lsqr(A, (b + b_addition))[0]
-
-        u = np.zeros(n, dtype=int)
-        u[~m] = f[~m]
-        u[m] = x
-        uImg = u.reshape((nx, ny), order='F')
-        final[:,:,ch] = uImg
-
-    return final
\ No newline at end of file
+def maskBounds(mask: ndarray, padding: int = 0):
+    rows = np.any(mask, axis=1)
+    cols = np.any(mask, axis=0)
+    if not rows.any():
+        return None
+
+    x0 = max(0, int(np.argmax(rows)) - padding)
+    x1 = min(mask.shape[0], mask.shape[0] - int(np.argmax(rows[::-1])) + padding)
+    y0 = max(0, int(np.argmax(cols)) - padding)
+    y1 = min(mask.shape[1], mask.shape[1] - int(np.argmax(cols[::-1])) + padding)
+    return np.s_[x0:x1, y0:y1]
+
+POISSON_SOLVERS = ('direct', 'lsqr', 'multigrid', 'dst')
+POISSON_TOL = 1e-6
+
+
+class PoissonWarmStart:
+    # State carried from one poisson_edit to the next. The system matrix only
+    # depends on the mask inside the ROI, so when that is unchanged (the
+    # insert was translated) its factorization or multigrid hierarchy is
+    # reused; the last solution, aligned at the ROI corner so that it moves
+    # with the insert, is the initial guess of the iterative solvers.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.key = None
+        self.operator = None
+        self.solution = None
+
+    @staticmethod
+    def maskKey(mask: ndarray, solver: str) -> str:
+        digest = hashlib.blake2b(f"{mask.shape}{solver}".encode(), digest_size=16)
+        digest.update(np.packbits(mask).data)
+        return digest.hexdigest()
+
+    def initialGuess(self, combined: ndarray) -> ndarray:
+        # combined is the (nx, ny, nc) ROI with the target under the mask;
+        # it fills whatever the previous solution does not cover.
+        with self.lock:
+            previous = self.solution
+        if previous is None or previous.shape[2] != combined.shape[2]:
+            return None
+        guess = combined.astype(float)
+        rows = min(guess.shape[0], previous.shape[0])
+        cols = min(guess.shape[1], previous.shape[1])
+        guess[:rows, :cols] = previous[:rows, :cols]
+        return guess
+
+    def cachedOperator(self, key: str):
+        with self.lock:
+            return self.operator if key == self.key else None
+
+    def update(self, key: str, operator, solution: ndarray):
+        with self.lock:
+            self.key = key
+            self.operator = operator
+            self.solution = solution
+
+
+def poisson_edit(source: ndarray, target: ndarray, mask: ndarray, solver: str = 'direct',
+                 info: dict = None, callback=None, warmStart: PoissonWarmStart = None) -> ndarray:
+    if solver not in POISSON_SOLVERS:
+        raise ValueError(f"Unknown Poisson solver '{solver}'.")
+
+    final = source.astype(int)
+
+    # Only pixels next to the mask enter the system, so solving on the
+    # dilated mask's bounding box plus a one-pixel Dirichlet border gives
+    # the same result as solving on the whole canvas.
+    with span('poisson.roi', mask=mask):
+        roi = maskBounds(mask, padding=2)
+    if info is not None:
+        info.update(solver=solver, roi=roi, unknowns=0, iterations=0, residual=0.0,
+                    warm=False, reusedOperator=False, solveTime=0.0)
+    if roi is None:
+        return final
+
+    final[roi] = poisson_solve(source[roi], target[roi], mask[roi], solver, info, callback, warmStart)
+    return final
+
+def poisson_solve(source: ndarray, target: ndarray, mask: ndarray, solver: str,
+                  info: dict = None, callback=None, warmStart: PoissonWarmStart = None) -> ndarray:
+    with span('poisson.assemble', source=source) as assembly:
+        combinedImage = source.copy()
+        dilatedMask = ndimage.binary_dilation(mask, np.ones((3, 3)))
+        combinedImage[dilatedMask] = target[dilatedMask]
+
+        nx, ny, nc = source.shape
+        m = mask.reshape(ny*nx, order='F')
+
+        Dx = sparse.kron(sparse.identity(ny), D_matrix(nx))
+        Dy = sparse.kron(D_matrix(ny), sparse.identity(nx))
+        Dhat = sparse.vstack([Dx, Dy])
+
+        n = nx*ny
+        nr = np.sum(m)
+
+        data = np.ones(nr)
+        j = range(nr)
+        i = np.where(m)[0]
+        I = sparse.coo_matrix((data, (i, j)), shape=(n, nr))
+
+        f = source.reshape((n, nc), order='F')
+        h = combinedImage.reshape((n, nc), order='F')
+        A = (Dhat@I).tocsr()
+        b = Dhat@(h - (1-m)[:,None]*f)
+        # Normal equations of the least-squares system: L is the masked Laplacian.
+        rhs = A.T@b
+        assembly.set(unknowns=int(nr), nonzeros=int(A.nnz))
+
+    # With no Dirichlet pixel (the mask covers the whole ROI) the Laplacian
+    # is singular and the solution is only defined up to a constant:
+    # 'direct' pins the first unknown, and the multigrid hierarchy, whose
+    # coarsest level would be singular too, gives way to lsqr.
+    singular = bool(m.all())
+    if singular and solver == 'multigrid':
+        solver = 'lsqr'
+
+    # Only the iterative solvers take an initial guess; the direct ones
+    # reuse the operator alone.
+    key = operator = x0 = None
+    reused = False
+    if warmStart is not None and solver != 'dst':
+        key = PoissonWarmStart.maskKey(mask, solver)
+        operator = warmStart.cachedOperator(key)
+        reused = operator is not None
+        if solver in ('lsqr', 'multigrid'):
+            guess = warmStart.initialGuess(combinedImage)
+            if guess is not None:
+                x0 = guess.reshape((n, nc), order='F')[m]
+
+    start = time.perf_counter()
+    with span('poisson.solve', solver=solver, unknowns=int(nr), warm=x0 is not None,
+              reusedOperator=reused) as solve:
+        if solver == 'lsqr':
+            x = np.zeros((nr, nc))
+            iterations = 0
+            for ch in range(nc):
+                result = sparse.linalg.lsqr(A, b[:,ch], atol=POISSON_TOL, btol=POISSON_TOL,
+                                            x0=None if x0 is None else x0[:,ch])
+                x[:,ch] = result[0]
+                iterations += result[2]
+                if callback is not None:
+                    norm = np.linalg.norm(rhs[:,ch])
+                    callback(iterations, result[7] / norm if norm else 0.0)
+        elif solver == 'direct':
+            # splu itself cannot be interrupted; the callback runs before the
+            # factorization and before each channel's solve, where a cancel
+            # stops it, with the residual of the zero start.
+            if operator is None:
+                if callback is not None:
+                    callback(0, 1.0)
+                L = (A.T@A).tocsc()
+                if singular:
+                    L = L[1:,1:]
+                operator = sparse.linalg.splu(L, permc_spec='MMD_AT_PLUS_A')
+            x = np.zeros((nr, nc))
+            pinned = 1 if singular else 0
+            for ch in range(nc):
+                if callback is not None:
+                    callback(0, 1.0)
+                x[pinned:,ch] = operator.solve(rhs[pinned:,ch])
+            iterations = 1
+        elif solver == 'multigrid':
+            if operator is None:
+                operator = multigrid_levels((A.T@A).tocsr(), mask)
+            x, iterations = multigrid_solve(operator[0]['A'], rhs, mask, callback=callback,
+                                            x0=x0, levels=operator)
+        else:
+            x = dst_solve(rhs, mask)
+            iterations = 1
+        if singular:
+            # Every solver has landed on its own constant; take the one
+            # that keeps the mean of the target, which the gradients came from.
+            x += h.mean(axis=0) - x.mean(axis=0)
+        solve.set(iterations=int(iterations))
+    solveTime = time.perf_counter() - start
+
+    if key is not None:
+        solution = h.astype(float)
+        solution[m] = x
+        warmStart.update(key, operator, solution.reshape((nx, ny, nc), order='F'))
+
+    residual = relative_residual(A, x, rhs)
+    if callback is not None and solver in ('direct', 'dst'):
+        callback(iterations, residual)
+    if info is not None:
+        # solver is the one that ran, which the singular case may have changed.
+        info.update(solver=solver, unknowns=int(nr), iterations=int(iterations), residual=residual,
+                    warm=x0 is not None, reusedOperator=reused, solveTime=solveTime)
+
+    u = f.astype(int)
+    u[m] = x
+    final = u.reshape((nx, ny, nc), order='F')
+
+    return final
+
+def relative_residual(A, x: ndarray, rhs: ndarray) -> float:
+    norm = np.linalg.norm(rhs)
+    return float(np.linalg.norm(rhs - A.T@(A@x)) / norm) if norm else 0.0
+
+def interpolation_matrix(n: int):
+    # 1D linear interpolation from the coarse nodes (every even fine index)
+    # to the fine grid; a trailing odd node copies its left neighbour.
+    nCoarse = (n + 1) // 2
+    fine = np.arange(n)
+    left = fine // 2
+    right = np.minimum(left + 1, nCoarse - 1)
+    odd = (fine % 2 == 1) & (right != left)
+    rows = np.concatenate([fine, fine[odd]])
+    cols = np.concatenate([left, right[odd]])
+    vals = np.concatenate([np.where(odd, 0.5, 1.0), np.full(np.sum(odd), 0.5)])
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(n, nCoarse))
+
+def multigrid_levels(L, mask: ndarray, coarsest: int = 500) -> list:
+    levels = []
+    while True:
+        diag = L.diagonal()
+        levels.append({'A': L, 'invDiag': 1.0 / diag})
+        nx, ny = mask.shape
+        if L.shape[0] <= coarsest or min(nx, ny) < 3:
+            break
+
+        # Galerkin coarsening with bilinear interpolation, restricted to
+        # the masked fine pixels and the coarse nodes they depend on.
+        P = sparse.kron(interpolation_matrix(ny), interpolation_matrix(nx)).tocsr()
+        P = P[np.where(mask.reshape(-1, order='F'))[0]]
+        keep = np.asarray(P.getnnz(axis=0) > 0)
+        P = P[:,keep].tocsr()
+        levels[-1]['P'] = P
+
+        L = (P.T@L@P).tocsr()
+        mask = keep.reshape(((nx + 1) // 2, (ny + 1) // 2), order='F')
+
+    levels[-1]['solve'] = sparse.linalg.splu(L.tocsc(), permc_spec='MMD_AT_PLUS_A').solve
+    return levels
+
+def multigrid_vcycle(levels: list, k: int, x: ndarray, rhs: ndarray,
+                     smoothing: int = 2, omega: float = 0.8) -> ndarray:
+    level = levels[k]
+    if 'solve' in level:
+        return level['solve'](rhs)
+
+    A = level['A']
+    invDiag = level['invDiag'][:,None]
+    for _ in range(smoothing):
+        x = x + omega * invDiag * (rhs - A@x)
+
+    P = level['P']
+    coarseRhs = P.T@(rhs - A@x)
+    x = x + P@multigrid_vcycle(levels, k + 1, np.zeros_like(coarseRhs), coarseRhs, smoothing, omega)
+
+    for _ in range(smoothing):
+        x = x + omega * invDiag * (rhs - A@x)
+    return x
+
+def multigrid_solve(L, rhs: ndarray, mask: ndarray, maxIterations: int = 100, callback=None,
+                    x0: ndarray = None, levels: list = None):
+    # levels from an earlier multigrid_levels(L, mask) skip the setup.
+    if levels is None:
+        levels = multigrid_levels(L, mask)
+    x = np.zeros_like(rhs) if x0 is None else x0.astype(rhs.dtype)
+    norm = np.linalg.norm(rhs)
+    if not norm:
+        return x, 0
+
+    # A warm start may already be converged.
+    if x0 is not None and np.linalg.norm(rhs - L@x) / norm <= POISSON_TOL:
+        return x, 0
+
+    for iteration in range(1, maxIterations + 1):
+        x = multigrid_vcycle(levels, 0, x, rhs)
+        residual = np.linalg.norm(rhs - L@x) / norm
+        if callback is not None:
+            callback(iteration, residual)
+        if residual <= POISSON_TOL:
+            break
+    return x, iteration
+
+def dst_solve(rhs: ndarray, mask: ndarray) -> ndarray:
+    bounds = maskBounds(mask)
+    if not mask[bounds].all():
+        raise ValueError("The 'dst' Poisson solver requires a rectangular mask.")
+
+    nx, ny = mask.shape
+    sx, sy = mask[bounds].shape
+    nc = rhs.shape[1]
+    u = rhs.reshape((sx, sy, nc), order='F')
+
+    # The masked Laplacian is a Kronecker sum of 1D operators with a
+    # Dirichlet end where the rectangle has a fixed neighbour and a Neumann
+    # end at the image border. Dirichlet-Dirichlet is diagonalized by DST-I,
+    # Neumann-Neumann by DCT-II, and a mixed axis by DST-I on the mirrored
+    # extension.
+    axes = []
+    for axis, (start, stop, size) in enumerate(((bounds[0].start, bounds[0].stop, nx),
+                                                (bounds[1].start, bounds[1].stop, ny))):
+        lowFixed = start > 0
+        highFixed = stop < size
+        length = u.shape[axis]
+        if lowFixed and not highFixed:
+            u = np.concatenate([u, np.flip(u, axis)], axis=axis)
+        elif highFixed and not lowFixed:
+            u = np.concatenate([np.flip(u, axis), u], axis=axis)
+
+        n = u.shape[axis]
+        if lowFixed or highFixed:
+            eigen = 2 - 2*np.cos(np.pi * np.arange(1, n + 1) / (n + 1))
+            u = fft.dst(u, type=1, axis=axis, norm='ortho')
+        else:
+            eigen = 2 - 2*np.cos(np.pi * np.arange(n) / n)
+            u = fft.dct(u, type=2, axis=axis, norm='ortho')
+        axes.append((lowFixed, highFixed, length, eigen))
+
+    eigen = axes[0][3][:,None,None] + axes[1][3][None,:,None]
+    # A zero eigenvalue only occurs when the mask covers the whole image;
+    # dropping that mode gives the minimum-norm solution, as lsqr does.
+    u = np.divide(u, eigen, out=np.zeros_like(u), where=eigen > 0)
+
+    for axis, (lowFixed, highFixed, length, _) in enumerate(axes):
+        if lowFixed or highFixed:
+            u = fft.idst(u, type=1, axis=axis, norm='ortho')
+        else:
+            u = fft.idct(u, type=2, axis=axis, norm='ortho')
+
+        if lowFixed and not highFixed:
+            u = np.take(u, np.arange(length), axis=axis)
+        elif highFixed and not lowFixed:
+            u = np.take(u, np.arange(length, 2*length), axis=axis)
+
+    return u.reshape((sx*sy, nc), order='F')
@@ -0,0 +1,44 @@
+import threading
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+
+class Cancelled(Exception):
+    pass
+
+
+class WorkerSignals(QObject):
+    progress = Signal(str)
+    finished = Signal(object)
+    error = Signal(Exception)
+    cancelled = Signal()
+
+
+class Worker(QRunnable):
+    def __init__(self, fn, *args, progressFormat: str = '{}', **kwargs):
+        super(Worker, self).__init__()
+        self.fn = fn
+        self.progressFormat = progressFormat
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.cancelEvent = threading.Event()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def callback(self, *values):
+        # Called from inside the running job; raising here unwinds it.
+        if self.cancelEvent.is_set():
+            raise Cancelled()
+        self.signals.progress.emit(self.progressFormat.format(*values))
+
+    def run(self):
+        try:
+            result = self.fn(*self.args, callback=self.callback, **self.kwargs)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.error.emit(e)
+        else:
+            self.signals.finished.emit(result)
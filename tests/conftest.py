@@ -0,0 +1,25 @@
+import os
+import sys
+
+# Headless, and results must come from the code under test rather than
+# from the result cache of an earlier run. Both have to be set before the
+# modules read them on import.
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ['POISSON_CACHE_DIR'] = ''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from PySide6.QtWidgets import QApplication
+
+SAMPLES = ('boy.jpg', 'girl.jpg', 'pig.jpg', 'plane.jpg')
+
+
+@pytest.fixture(scope='session')
+def app():
+    return QApplication.instance() or QApplication([])
+
+@pytest.fixture(params=SAMPLES)
+def samplePath(request):
+    return os.path.join(ROOT, request.param)
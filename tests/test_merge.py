@@ -0,0 +1,33 @@
+import os
+
+from PySide6.QtCore import QThreadPool
+from PySide6.QtGui import QImage
+
+from src.merge import Merge
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_reset_detaches_the_running_preview(app):
+    merge = Merge(os.path.join(ROOT, 'tower.jpg'))
+    merge.livePreview = True
+    delivered = []
+    merge.onPreview = lambda *args: delivered.append(args)
+    insert = QImage(os.path.join(ROOT, 'boy.jpg')).convertToFormat(QImage.Format.Format_ARGB32).scaled(200, 200)
+
+    merge.paste(insert)
+    worker = merge.previewWorker
+    assert worker is not None
+    merge.reset()
+    QThreadPool.globalInstance().waitForDone()
+    app.processEvents()
+
+    assert worker.cancelEvent.is_set()
+    assert merge.previewWorker is None
+    assert delivered == []
+
+    # A preview that is left alone still arrives.
+    merge.paste(insert)
+    QThreadPool.globalInstance().waitForDone()
+    app.processEvents()
+    assert len(delivered) == 1
@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+
+from src import network
+
+
+def test_train_retries_a_dead_network(monkeypatch):
+    initialize = network.Network.__init__
+    built = []
+
+    def deadFirstInit(self, *args):
+        # The first network has every ReLU dead and a zero output layer, so
+        # it predicts the same for every sample and can only reach the class
+        # prior; the retries get ordinary ones.
+        initialize(self, *args)
+        built.append(self)
+        if len(built) == 1:
+            with torch.no_grad():
+                self.fc1.weight.zero_()
+                self.fc1.bias.fill_(-1)
+                self.fc3.weight.zero_()
+                self.fc3.bias.zero_()
+
+    monkeypatch.setattr(network.Network, '__init__', deadFirstInit)
+
+    rng = np.random.default_rng(0)
+    labels = np.repeat([0, 1], 100)
+    data = rng.normal(size=(200, 5)).astype(np.float32)
+    data[:, 0] += 4 * labels
+    info = {}
+    probabilities = network.train(data, labels, data, info=info)
+
+    assert info['attempts'] > 1
+    assert info['stopReason'] != 'stalled'
+    assert np.mean(probabilities.argmax(axis=1) == labels) > 0.9
+
+def test_batches_draw_only_training_rows():
+    labels = torch.tensor([0] * 300 + [1] * 100)
+    data = torch.arange(400, dtype=torch.float32)[:, None].repeat(1, 5)
+    trainIdx, valIdx = network.splitValidation(labels)
+
+    loader, weight = network.batches(data, labels, trainIdx, 64)
+    drawn = torch.cat([batchData[:, 0] for batchData, _ in loader])
+
+    # The sampler balances the classes, so the loss is unweighted.
+    assert weight is None
+
+    assert drawn.shape[0] == trainIdx.shape[0]
+    assert not torch.isin(drawn.long(), valIdx).any()
+    # Class-balanced: about as many object rows as background ones.
+    assert abs(labels[drawn.long()].float().mean().item() - 0.5) < 0.1
+
+def separable(rng, counts):
+    labels = np.repeat(np.arange(len(counts)), counts)
+    data = rng.normal(size=(labels.shape[0], 5)).astype(np.float32)
+    data[:, 0] += 4 * labels
+    return data, labels
+
+def test_warm_start_without_new_samples_reuses_the_network():
+    data, labels = separable(np.random.default_rng(0), (300, 100))
+    model = {}
+    expected = network.train(data, labels, data, model=model)
+    cached = model['net']
+
+    info = {}
+    probabilities = network.train(data[:0], labels[:0], data, info=info, model=model, classes=2,
+                                  validation=(data, labels))
+
+    assert model['net'] is cached
+    assert info['stopReason'] == 'cached' and info['epochs'] == 0
+    assert np.array_equal(probabilities, expected)
+
+def test_worse_fine_tune_falls_back_to_a_full_retrain():
+    rng = np.random.default_rng(0)
+    data, labels = separable(rng, (300, 100))
+    model = {}
+    network.train(data, labels, data, model=model)
+
+    # Background strokes right on the object: fine-tuning on them alone
+    # unlearns the object, which all scribbles together do not allow.
+    newData = data[labels == 1][:40]
+    newLabels = np.zeros(40, dtype=np.int64)
+    allData = np.concatenate((data, newData))
+    allLabels = np.concatenate((labels, newLabels))
+    info = {}
+    probabilities = network.train(newData, newLabels, data, info=info, model=model, classes=2,
+                                  validation=(allData, allLabels))
+
+    assert not info['warmStart']
+    assert info['samples'] == allData.shape[0]
+    assert np.mean(probabilities.argmax(axis=1)[labels == 1] == 1) > 0.5
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from PySide6.QtGui import QColor, QImage
+import qimage2ndarray as q2a
+
+from src.scribble import replaySample, writeMask
+
+
+def loopWriteMask(maskImage: QImage, probabilities: np.ndarray, threshold: float):
+    # The per-pixel write-back that writeMask replaced.
+    maskImage.fill(QColor(0, 0, 0, 0))
+    for x in range(maskImage.width()):
+        for y in range(maskImage.height()):
+            if probabilities[y][x] >= threshold:
+                maskImage.setPixelColor(x, y, QColor('#00FF00'))
+
+
+@pytest.mark.parametrize('threshold', (0.625, 0.75, 0.875))
+def test_writeMask_matches_pixel_loop(threshold):
+    rng = np.random.default_rng(0)
+    foreground = rng.random((37, 53)).astype(np.float32)
+    # Probabilities exactly at the threshold are part of the mask; the
+    # thresholds are exact in float32, so both versions compare the same value.
+    foreground[0, :5] = threshold
+    probabilities = np.stack((1 - foreground, foreground), axis=-1)
+
+    expected = QImage(53, 37, QImage.Format.Format_ARGB32)
+    loopWriteMask(expected, foreground, threshold)
+    actual = QImage(53, 37, QImage.Format.Format_ARGB32)
+    segmented = writeMask(actual, probabilities, threshold)
+
+    assert np.array_equal(q2a.raw_view(actual), q2a.raw_view(expected))
+    assert np.array_equal(segmented == 1, foreground >= threshold)
+
+def test_replaySample_takes_an_equal_share_per_class():
+    np.random.seed(0)
+    labels = np.repeat([0, 1, 2], [5000, 300, 40])
+
+    replay = replaySample(labels, 600)
+
+    assert np.unique(replay).shape[0] == replay.shape[0]
+    assert np.array_equal(np.bincount(labels[replay]), [200, 200, 40])
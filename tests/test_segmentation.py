@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from src import network
+from src.segmentation import createBackend
+from src.worker import Cancelled
+
+
+def test_knn_prediction_stops_at_the_callback(monkeypatch):
+    monkeypatch.setattr(network, 'CHUNK_SIZE', 1024)
+    rng = np.random.default_rng(0)
+    labels = np.repeat([0, 1], 100)
+    data = rng.normal(size=(200, 5)).astype(np.float32)
+    img = rng.integers(0, 256, (64, 64, 3)).astype(np.uint8)
+    chunks = []
+
+    def callback(chunk, done):
+        chunks.append(done)
+        if len(chunks) == 3:
+            raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        createBackend('knn').segment(data, labels, img, callback)
+    # One call per chunk of 1024 pixels, with the fraction done so far.
+    assert chunks == [0.0, 0.25, 0.5]
@@ -0,0 +1,25 @@
+import numpy as np
+from PySide6.QtGui import QImage, QImageReader
+
+from src.tiles import TiledImage
+from src.utils import convertQ2N
+
+
+def test_png_round_trip_in_bands(app, samplePath, tmp_path):
+    # The band-wise PNG writer and the full decode of a format without clip
+    # rects, with the allocation limit below the size of the image.
+    source = TiledImage.fromFile(samplePath, tileSize=64)
+    path = str(tmp_path / 'out.png')
+    source.save(path)
+
+    decoded = QImage(path).convertToFormat(QImage.Format.Format_ARGB32)
+    assert np.array_equal(convertQ2N(decoded), source.pixels)
+
+    limit = QImageReader.allocationLimit()
+    QImageReader.setAllocationLimit(1)
+    try:
+        reloaded = TiledImage.fromFile(path, tileSize=64)
+        assert QImageReader.allocationLimit() == 1
+    finally:
+        QImageReader.setAllocationLimit(limit)
+    assert np.array_equal(reloaded.pixels, source.pixels)
@@ -0,0 +1,163 @@
+import os
+
+import numpy as np
+import pytest
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QColor, QImage
+import qimage2ndarray as q2a
+
+from src.utils import POISSON_SOLVERS, convertQ2N, poisson_edit, trimImage
+from src.worker import Cancelled
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loopTrimImage(img: QImage, mask: QImage) -> QImage:
+    # The row/column loops and per-pixel copy that trimImage replaced.
+    alpha = q2a.recarray_view(mask)['alpha']
+    boundX0 = 0
+    boundX1 = alpha.shape[0]
+    boundY0 = 0
+    boundY1 = alpha.shape[1]
+
+    for x in range(alpha.shape[0]):
+        if np.sum(alpha[x,:]):
+            boundX0 = x
+            break
+
+    for x in reversed(range(alpha.shape[0])):
+        if np.sum(alpha[x,:]):
+            boundX1 = x
+            break
+
+    for y in range(alpha.shape[1]):
+        if np.sum(alpha[:,y]):
+            boundY0 = y
+            break
+
+    for y in reversed(range(alpha.shape[1])):
+        if np.sum(alpha[:,y]):
+            boundY1 = y
+            break
+
+    boundX0 = max(0, boundX0 - 3)
+    boundX1 = min(alpha.shape[0], boundX1 + 3)
+    boundY0 = max(0, boundY0 - 3)
+    boundY1 = min(alpha.shape[1], boundY1 + 3)
+
+    newImg = QImage((boundY1 - boundY0), (boundX1 - boundX0), QImage.Format.Format_ARGB32)
+    newImg.fill(QColor(0, 0, 0, 0))
+
+    for x in range(newImg.size().height()):
+        for y in range(newImg.size().width()):
+            newImg.setPixelColor(y, x, img.pixelColor(y + boundY0, x + boundX0))
+
+    return newImg
+
+def loadImage(path: str, size: int = 160) -> QImage:
+    img = QImage(path)
+    assert not img.isNull(), path
+    img = img.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+    return img.convertToFormat(QImage.Format.Format_ARGB32)
+
+def sampleArray(name: str, width: int, height: int) -> np.ndarray:
+    img = QImage(os.path.join(ROOT, name)).scaled(width, height, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                                  Qt.TransformationMode.SmoothTransformation)
+    # The view does not keep its QImage alive, so the image is held until
+    # the copy is taken.
+    img = img.convertToFormat(QImage.Format.Format_ARGB32)
+    return convertQ2N(img).copy()
+
+def maskImage(mask: np.ndarray) -> QImage:
+    img = QImage(mask.shape[1], mask.shape[0], QImage.Format.Format_ARGB32)
+    img.fill(QColor(0, 0, 0, 0))
+    q2a.raw_view(img)[mask] = 0xFF00FF00
+    return img
+
+def ellipse(height: int, width: int) -> np.ndarray:
+    # Off-center, so the padding is clipped on no side and the crop is asymmetric.
+    rows, cols = np.indices((height, width))
+    return ((rows - 0.4 * height) / (0.25 * height))**2 + ((cols - 0.55 * width) / (0.3 * width))**2 <= 1
+
+def border(height: int, width: int) -> np.ndarray:
+    # Touches the top and right edges, so the padding is clipped there.
+    mask = np.zeros((height, width), dtype=bool)
+    mask[:height // 3, width // 2:] = True
+    return mask
+
+def empty(height: int, width: int) -> np.ndarray:
+    return np.zeros((height, width), dtype=bool)
+
+
+@pytest.mark.parametrize('makeMask', (ellipse, border, empty))
+def test_trimImage_matches_loop(app, samplePath, makeMask):
+    img = loadImage(samplePath)
+    mask = maskImage(makeMask(img.height(), img.width()))
+
+    for source in (img, mask):
+        expected = loopTrimImage(source, mask)
+        actual = trimImage(source, mask)
+        assert actual.size() == expected.size()
+        assert np.array_equal(q2a.raw_view(actual), q2a.raw_view(expected))
+
+def rectangle(height: int, width: int) -> np.ndarray:
+    mask = np.zeros((height, width), dtype=bool)
+    mask[height // 4:height // 2, width // 3:3 * width // 4] = True
+    return mask
+
+def edgeRectangle(height: int, width: int) -> np.ndarray:
+    # Neumann on the left and bottom, Dirichlet on the other two sides.
+    mask = np.zeros((height, width), dtype=bool)
+    mask[height // 2:, :width // 2] = True
+    return mask
+
+def whole(height: int, width: int) -> np.ndarray:
+    # No Dirichlet boundary at all: the Laplacian is singular.
+    return np.ones((height, width), dtype=bool)
+
+# 'dst' only takes rectangular masks, so the ellipse skips it.
+SOLVER_CASES = [(solver, makeMask) for solver in ('direct', 'multigrid', 'dst')
+                for makeMask in (rectangle, edgeRectangle, ellipse, whole)
+                if solver != 'dst' or makeMask is not ellipse]
+
+@pytest.mark.parametrize('solver, makeMask', SOLVER_CASES)
+def test_poisson_solvers_match_lsqr(app, solver, makeMask):
+    source = sampleArray('tower.jpg', 96, 72)
+    target = sampleArray('boy.jpg', 96, 72)
+    mask = makeMask(72, 96)
+
+    expected = poisson_edit(source, target, mask, 'lsqr')
+    actual = poisson_edit(source, target, mask, solver)
+
+    # lsqr stops at a relative tolerance and the result is truncated to
+    # integers, so the solvers may disagree by one level here and there.
+    assert np.abs(actual - expected).max() <= 1
+    assert np.array_equal(actual[~mask], source[~mask])
+
+@pytest.mark.parametrize('solver', POISSON_SOLVERS)
+def test_poisson_whole_mask_keeps_target(app, solver):
+    # Pinned to the target's mean, the singular system gives back the target.
+    source = sampleArray('tower.jpg', 96, 72)
+    target = sampleArray('boy.jpg', 96, 72)
+
+    info = {}
+    result = poisson_edit(source, target, whole(72, 96), solver, info)
+
+    assert np.abs(result - target.astype(int)).max() <= 1
+    # Multigrid gives way to lsqr here, and says so.
+    assert info['solver'] == ('lsqr' if solver == 'multigrid' else solver)
+
+def test_direct_solve_stops_at_the_callback(app):
+    source = sampleArray('tower.jpg', 96, 72)
+    target = sampleArray('boy.jpg', 96, 72)
+    calls = []
+
+    def callback(iteration, residual):
+        calls.append(iteration)
+        # Past the factorization, before the first channel is solved.
+        if len(calls) == 2:
+            raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        poisson_edit(source, target, ellipse(72, 96), 'direct', callback=callback)
+    assert len(calls) == 2